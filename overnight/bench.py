@@ -0,0 +1,179 @@
+"""Benchmarks of the evaluator over a corpus of recorded chains.
+
+This times each stage of the analysis (normalization, expected move estimation,
+term evaluation, the whole name) separately for every chain of a corpus, and
+the end-to-end analysis and rendering of the corpus as a run. Latencies are
+reported as percentiles per name, and the peak memory allocated by each stage
+is measured on a separate pass, as tracing allocations slows everything down.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Callable, Dict, List, NamedTuple
+import collections
+import math
+import tempfile
+import time
+import tracemalloc
+
+from overnight import earnings_pb2 as pb
+from overnight import evaluate
+
+
+Json = evaluate.Json
+
+# Percentiles reported for per-name latencies.
+PERCENTILES = [50, 90, 99]
+
+# Upper bounds on the number of options of the size classes of chains.
+SIZE_CLASSES = [('small', 200), ('medium', 1000), ('large', float('inf'))]
+
+
+class Stage(NamedTuple):
+    """Latencies of one stage, in seconds, and its peak memory, in bytes."""
+    name: str
+    latencies: List[float]
+    peak_bytes: int
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return a percentile of a list of values, by the nearest rank method."""
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    rank = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def maximum(values: List[float]) -> float:
+    """Return the largest of a list of values, NaN if there are none."""
+    return max(values, default=float('nan'))
+
+
+def count_options(chain_json: Json) -> int:
+    """Return the number of options in a chain."""
+    return sum(len(strikes)
+               for field in ('callExpDateMap', 'putExpDateMap')
+               for strikes in chain_json[field].values())
+
+
+def get_size_class(chain_json: Json) -> str:
+    """Return the name of the size class of a chain."""
+    num_options = count_options(chain_json)
+    return next(name for name, bound in SIZE_CLASSES if num_options <= bound)
+
+
+def time_calls(func: Callable[..., Any], args_list: List[tuple], repeat: int) -> List[float]:
+    """Time a function on each of a list of arguments, keeping the best of a
+    number of repetitions for each."""
+    latencies = []
+    for args in args_list:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            best = min(best, time.perf_counter() - start)
+        latencies.append(best)
+    return latencies
+
+
+def measure_peak(func: Callable[..., Any], args_list: List[tuple]) -> int:
+    """Return the largest peak of memory allocated by a function over a list of
+    arguments."""
+    peak = 0
+    tracemalloc.start()
+    try:
+        for args in args_list:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            func(*args)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_stage(name: str, func: Callable[..., Any], args_list: List[tuple],
+              repeat: int) -> Stage:
+    """Time and measure a stage over a list of arguments."""
+    return Stage(name, time_calls(func, args_list, repeat), measure_peak(func, args_list))
+
+
+def run_benchmarks(chains: List[Json], config: pb.Config, repeat: int = 3) -> List[Stage]:
+    """Run all the benchmarks over a corpus of valid chains."""
+    stages = []
+
+    # Per-name stages. The estimation and terms are timed over all the selected
+    # expirations of a name, like the analysis does.
+    stages.append(run_stage('normalize_chain', evaluate.normalize_chain,
+                            [(chain_json,) for chain_json in chains], repeat))
+    normalized = [evaluate.normalize_chain(chain_json) for chain_json in chains]
+    selected = [(chain, evaluate.select_expirations(chain, config)) for chain in normalized]
+
+    def estimate(chain, expis):
+        for expi in expis:
+            evaluate.estimate_expected_move(chain.info, expi)
+    stages.append(run_stage('estimate_expected_move', estimate, selected, repeat))
+
+    def terms(chain, expis):
+        for expi in expis:
+            evaluate.get_term(chain, expi, config)
+    stages.append(run_stage('get_term', terms, selected, repeat))
+
+    stages.append(run_stage('analyze_earnings', evaluate.analyze_earnings,
+                            [(chain_json, config) for chain_json in chains], repeat))
+
+    # The same, by size class of the chains.
+    by_class = collections.defaultdict(list)
+    for chain_json in chains:
+        by_class[get_size_class(chain_json)].append((chain_json, config))
+    for name, _ in SIZE_CLASSES:
+        if by_class[name]:
+            stages.append(run_stage(f'analyze_earnings[{name}]', evaluate.analyze_earnings,
+                                    by_class[name], repeat))
+
+    # End-to-end stages, over the whole corpus.
+    earlist = pb.EarningsList()
+    earlist.earnings.extend(evaluate.analyze_earnings(chain_json, config)
+                            for chain_json in chains)
+    symbols = [earnings.underlying for earnings in earlist.earnings]
+    with tempfile.TemporaryDirectory() as output_dir:
+        stages.append(run_stage('render_files', evaluate.render_files,
+                                [(symbols, config, earlist, output_dir)], repeat))
+
+        def end_to_end():
+            results = pb.EarningsList()
+            results.earnings.extend(evaluate.analyze_earnings(chain_json, config)
+                                    for chain_json in chains)
+            evaluate.render_files(symbols, config, results, output_dir)
+        stages.append(run_stage('end_to_end', end_to_end, [()], repeat))
+
+    return stages
+
+
+def format_report(stages: List[Stage]) -> str:
+    """Format a table of latencies and memory peaks for the stages."""
+    header = (f"{'stage':32} {'n':>6} " +
+              " ".join(f"{'p' + str(pct) + ' ms':>10}" for pct in PERCENTILES) +
+              f" {'max ms':>10} {'total s':>9} {'peak MB':>8}")
+    lines = [header, '-' * len(header)]
+    for stage in stages:
+        lines.append(
+            f"{stage.name:32} {len(stage.latencies):6d} " +
+            " ".join(f"{percentile(stage.latencies, pct) * 1000:10.3f}"
+                     for pct in PERCENTILES) +
+            f" {maximum(stage.latencies) * 1000:10.3f} {sum(stage.latencies):9.3f}"
+            f" {stage.peak_bytes / 1e6:8.2f}")
+    return "\n".join(lines)
+
+
+def report_to_json(stages: List[Stage]) -> Dict[str, Any]:
+    """Summarize the stages as a JSON-compatible dict, for comparing runs."""
+    return {stage.name: {'count': len(stage.latencies),
+                         **{f'p{pct}': percentile(stage.latencies, pct)
+                            for pct in PERCENTILES},
+                         'max': maximum(stage.latencies),
+                         'total': sum(stage.latencies),
+                         'peak_bytes': stage.peak_bytes}
+            for stage in stages}
@@ -0,0 +1,115 @@
+"""A persistent cache of raw chain responses.
+
+Each entry is a gzipped JSON document named by a hash of the request's
+parameters. Freshness is judged by the time an entry was written; eviction is
+least-recently-used, by the access time we set on every hit.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Any, Optional
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from overnight import chainjson
+
+
+# Defaults for the cache.
+DEFAULT_TTL_SECS = 60 * 60
+DEFAULT_MAX_MB = 512
+
+
+def cache_key(**kwargs) -> str:
+    """Return a content hash for the parameters of a request."""
+    canonical = repr(sorted((key, str(value)) for key, value in kwargs.items()))
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()
+
+
+class ChainCache:
+    """A directory of compressed chains with a time-to-live and a size cap."""
+
+    def __init__(self, directory: str,
+                 ttl_secs: float = DEFAULT_TTL_SECS,
+                 max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, **kwargs) -> str:
+        """Return the filename for the entry of a request."""
+        return path.join(self.directory, f"{cache_key(**kwargs)}.json.gz")
+
+    def get(self, **kwargs) -> Optional[Any]:
+        """Return a fresh cached response for the request, or None."""
+        filename = self.filename(**kwargs)
+        try:
+            stat = os.stat(filename)
+            if time.time() - stat.st_mtime > self.ttl_secs:
+                return None
+            with gzip.open(filename, 'rb') as infile:
+                data = infile.read()
+            # Mark as recently used, preserving the write time.
+            os.utime(filename, (time.time(), stat.st_mtime))
+        except (OSError, EOFError):
+            return None
+        logging.info(f"Cache hit for {kwargs.get('symbol', filename)}")
+        return chainjson.loads(data)
+
+    def put(self, response: Any, **kwargs):
+        """Store a response for the request and evict old entries if needed."""
+        filename = self.filename(**kwargs)
+        tmpname = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmpname, 'wb') as outfile:
+            outfile.write(chainjson.dumps(response))
+        os.replace(tmpname, filename)
+        self.evict()
+
+    def evict(self):
+        """Remove the least-recently used entries until under the size cap."""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json.gz'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                total -= size
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add chain cache options to an argument parser."""
+    parser.add_argument('--chain-cache', action='store',
+                        help="Directory for caching raw chains across runs")
+    parser.add_argument('--cache-ttl', action='store', type=float,
+                        default=DEFAULT_TTL_SECS,
+                        help="Age in seconds after which cached chains are refetched")
+    parser.add_argument('--cache-max-mb', action='store', type=float,
+                        default=DEFAULT_MAX_MB,
+                        help="Maximum size of the chain cache in megabytes")
+
+
+def cache_from_args(args: argparse.Namespace) -> Optional[ChainCache]:
+    """Create a chain cache from parsed options, or None if disabled."""
+    if not args.chain_cache:
+        return None
+    return ChainCache(args.chain_cache, args.cache_ttl,
+                      int(args.cache_max_mb * 1024 * 1024))
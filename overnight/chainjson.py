@@ -0,0 +1,160 @@
+"""Serialization of raw TD chain responses.
+
+The API library returns documents whose objects allow attribute access and
+whose numbers are Decimal instances. This module writes them out as plain JSON
+and reads them back into the same shape, so that stored chains are
+indistinguishable from freshly fetched ones.
+
+There is also a fast path for analysis, which uses msgspec (if installed) to
+decode straight into typed structures holding only the fields the analysis
+uses, skipping the rest of the document without materializing it.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from decimal import Decimal
+from typing import Any, Optional
+import datetime
+import functools
+import json
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class AttrDict(dict):
+    """A dict whose keys are also accessible as attributes."""
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _default(obj: Any) -> Any:
+    """Convert values the json module does not know about."""
+    if isinstance(obj, Decimal):
+        # Floats round-trip to the shortest repr, which is the original text
+        # for all the prices and greeks TD sends us.
+        return float(obj)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if msgspec is not None and isinstance(obj, msgspec.Struct):
+        return msgspec.structs.asdict(obj)
+    raise TypeError(f"Cannot serialize {type(obj)}")
+
+
+def dumps(chain_json: Any) -> bytes:
+    """Serialize a response to JSON bytes."""
+    return json.dumps(chain_json, default=_default, separators=(',', ':')).encode('utf8')
+
+
+def loads(data: bytes) -> Any:
+    """Parse JSON bytes back into a response."""
+    return json.loads(data, object_hook=AttrDict, parse_float=Decimal)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_expiration_key(key: str) -> datetime.date:
+    """Parse the date of an expiration map key, e.g. '2021-06-18:3'.
+
+    The same few dozen dates recur in the chains of every symbol of a run, so
+    they are parsed once.
+    """
+    return datetime.date.fromisoformat(key[:key.index(':')])
+
+
+if msgspec is not None:
+
+    class Option(msgspec.Struct):
+        """The fields of an option used by the analysis (and by refreshes)."""
+        strikePrice: Decimal
+        bid: Decimal
+        ask: Decimal
+        mark: Decimal
+        delta: Decimal
+        volatility: Decimal
+        bidSize: int
+        askSize: int
+        daysToExpiration: int
+        expirationDate: int
+        expirationType: str
+        symbol: str = ''
+        last: Optional[Decimal] = None
+        totalVolume: Optional[int] = None
+        openInterest: Optional[int] = None
+
+        # Support the same access as decoded dicts.
+        def __getitem__(self, key: str) -> Any:
+            return getattr(self, key)
+
+        def __setitem__(self, key: str, value: Any):
+            setattr(self, key, value)
+
+    class Underlying(msgspec.Struct):
+        """The fields of the underlying used by the analysis."""
+        symbol: str = ''
+        description: str = ''
+        mark: Optional[Decimal] = None
+        bid: Optional[Decimal] = None
+        ask: Optional[Decimal] = None
+        last: Optional[Decimal] = None
+        fiftyTwoWeekHigh: Optional[Decimal] = None
+        fiftyTwoWeekLow: Optional[Decimal] = None
+        percentChange: Optional[Decimal] = None
+        totalVolume: Optional[int] = None
+        quoteTime: Optional[int] = None
+
+    ExpDateMap = dict[str, dict[str, list[Option]]]
+
+    class Chain(msgspec.Struct):
+        """The fields of a chain used by the analysis."""
+        symbol: str = ''
+        status: str = ''
+        underlyingPrice: Optional[Decimal] = None
+        underlying: Optional[Underlying] = None
+        callExpDateMap: Optional[ExpDateMap] = None
+        putExpDateMap: Optional[ExpDateMap] = None
+
+    _chain_decoder = msgspec.json.Decoder(Chain)
+
+
+def _fix_nans(expmap: dict[str, dict[str, list[Any]]]):
+    """Restore the 'NaN' strings of greeks, which Decimal decoding converts."""
+    for strikes in expmap.values():
+        for datalist in strikes.values():
+            for option in datalist:
+                if option.delta.is_nan():
+                    option.delta = 'NaN'
+                if option.volatility.is_nan():
+                    option.volatility = 'NaN'
+
+
+def loads_chain(data: bytes) -> Any:
+    """Parse a chain for analysis, using the fast decoder if available.
+
+    The result has only the fields the analysis uses, and its options are
+    typed structures supporting both item and attribute access. This falls back
+    on `loads` when msgspec is not installed or the document does not decode as
+    a chain, including when it is not valid JSON to msgspec.
+    """
+    if msgspec is None:
+        return loads(data)
+    try:
+        decoded = _chain_decoder.decode(data)
+    except msgspec.DecodeError:
+        # Not a chain, or not JSON msgspec accepts (e.g. bare NaN numbers).
+        return loads(data)
+    chain = AttrDict((field, getattr(decoded, field))
+                     for field in decoded.__struct_fields__
+                     if getattr(decoded, field) is not None)
+    if decoded.underlying is not None:
+        chain['underlying'] = AttrDict(msgspec.structs.asdict(decoded.underlying))
+    for field in 'callExpDateMap', 'putExpDateMap':
+        if field in chain:
+            _fix_nans(chain[field])
+    return chain
@@ -5,12 +5,15 @@ __license__ = "GNU GPLv2"
 
 from decimal import Decimal
 from os import path
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, NamedTuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union, NamedTuple
 import argparse
+import bisect
 import collections
+import concurrent.futures
 import copy
 import csv
 import datetime
+import functools
 import io
 import logging
 import math
@@ -26,7 +29,14 @@ import click
 import jinja2
 
 from johnny.base.etl import petl, Table, Record
+from overnight import cache as cachelib
+from overnight import chainjson
 from overnight import earnings_pb2 as pb
+from overnight import moves
+from overnight import ratelimit
+from overnight import records
+from overnight import retry
+from overnight import timing
 
 
 Json = Union[Dict[str, 'Json'], List['Json'], str, int, float]
@@ -34,15 +44,58 @@ ZERO = Decimal('0')
 Q = Decimal('0.01')
 
 
+# TODO(blais): Move this to a input file.
+def initialize_default_config() -> pb.Config:
+    """Create an initialize a default configuration."""
+    config = pb.Config()
+
+    # Earnings beyond 45 days are pretty useless (not enough vol contraction).
+    config.max_dte = 60
+
+    # Don't play too tight; we won't bother with any position with a delta of 20
+    # or more.
+    config.max_delta = 0.20
+
+    # Don't trade stocks with less than 200k shares.
+    config.volume_threshold = 200_000
+
+    # Don't bother with positions that are too cheap; again, I wouldn't touch it
+    # if it's not at least $0.70.
+    config.min_strangle_credits = 0.40
+
+    # Don't bother trading names with spreads 50% of the option value.
+    config.max_spread_frac = 0.50
+
+    # Don't look at strikes with no size.
+    config.min_size = 1
+
+    # A wide strangle ought to be at least 2x the expected move.
+    config.strangle_em_width = 2.2
+
+    return config
+
+
 # Data for each strike in a chain.
 StrikeData = dict[str, Any]
 
 
+class StrikeIndex(NamedTuple):
+    """Sorted strike prices of one side of an expiration, for fast lookups.
+
+    The prices are always in increasing order; `descending` tells whether the
+    list of strikes it indexes is in the reverse order (as puts are).
+    """
+    prices: list[Decimal]
+    descending: bool
+
+
 class Expi(NamedTuple):
     """Data for one expiration."""
     info: dict[str, Any]
     puts: list[StrikeData]
     calls: list[StrikeData]
+    put_index: StrikeIndex
+    call_index: StrikeIndex
 
 
 class Chain(NamedTuple):
@@ -57,7 +110,7 @@ def normalize_chain(chain_json: Json) -> Chain:
     assert chain_json['callExpDateMap'].keys() == chain_json['putExpDateMap'].keys()
     expis = {}
     for expi_str in chain_json['callExpDateMap']:
-        expiration = parser.parse(expi_str.split(':')[0]).date()
+        expiration = chainjson.parse_expiration_key(expi_str)
 
         puts_json = chain_json['putExpDateMap'][expi_str]
         calls_json = chain_json['callExpDateMap'][expi_str]
@@ -71,7 +124,10 @@ def normalize_chain(chain_json: Json) -> Chain:
                 for attr in ['daysToExpiration', 'expirationDate', 'expirationType']}
         info['expiration'] = expiration
 
-        expis[expiration] = Expi(info, puts, calls)
+        put_index = StrikeIndex([strike['strikePrice'] for strike in reversed(puts)], True)
+        call_index = StrikeIndex([strike['strikePrice'] for strike in calls], False)
+
+        expis[expiration] = Expi(info, puts, calls, put_index, call_index)
 
     chain_info = chain_json.copy()
     del chain_info['callExpDateMap']
@@ -91,14 +147,21 @@ def find_regular_expirations(chain: Chain) -> Iterator[Expi]:
             yield expi
 
 
-def get_closest_strike(strikes: list[StrikeData],
+def get_closest_strike(strikes: StrikeIndex,
                        target_price: Decimal) -> tuple[Decimal, int]:
-    """Return the closest strike and index from the list."""
+    """Return the closest strike and its index in the indexed list. On ties, the
+    lower strike wins."""
     assert isinstance(target_price, Decimal)
-    _, strikePrice, index = min([
-        (abs(strike.strikePrice - target_price), strike.strikePrice, index)
-        for index, strike in enumerate(strikes)])
-    return strikePrice.quantize(Q), index
+    prices = strikes.prices
+    if not prices:
+        raise IndexError("No strikes")
+    pos = bisect.bisect_left(prices, target_price)
+    if pos == len(prices):
+        pos -= 1
+    elif pos > 0 and target_price - prices[pos - 1] <= prices[pos] - target_price:
+        pos -= 1
+    index = len(prices) - 1 - pos if strikes.descending else pos
+    return prices[pos].quantize(Q), index
 
 
 def index_with_default(alist: list[Any], index: int, default: Any) -> Any:
@@ -115,12 +178,12 @@ def estimate_expected_move(chain_info, expi: Expi) -> Optional[tuple[Decimal, De
     # Get the closest strikes for a series of concentric straddles.
     underlyingPrice = chain_info['underlying']['mark']
     try:
-        putStrikePrice, index = get_closest_strike(expi.puts, underlyingPrice)
+        putStrikePrice, index = get_closest_strike(expi.put_index, underlyingPrice)
         put0 = expi.puts[index]
         put1 = index_with_default(expi.puts, index + 1, None)
         put2 = index_with_default(expi.puts, index + 2, None)
 
-        callStrikePrice, index = get_closest_strike(expi.calls, underlyingPrice)
+        callStrikePrice, index = get_closest_strike(expi.call_index, underlyingPrice)
         call0 = expi.calls[index]
         call1 = index_with_default(expi.calls, index + 1, None)
         call2 = index_with_default(expi.calls, index + 2, None)
@@ -138,6 +201,12 @@ def estimate_expected_move(chain_info, expi: Expi) -> Optional[tuple[Decimal, De
 
     # Estimate using 60% of 1 strike strangle + 30% of 2 strike strangle + 10%
     # of 3 strike strangle.
+    #
+    # TODO(blais): Bug: the conditional expressions below bind looser than '+', so the
+    # second and third straddles count only the put's mark (or the call's if
+    # there is no put), not the sum of both. Fixing this raises all the
+    # expected moves, and with them the strike targets, so it needs its own
+    # change.
     em_straddles = (Decimal('0.60') * (put0.mark + call0.mark) +
                     Decimal('0.30') * (put1.mark if put1 else ZERO +
                                        call1.mark if call1 else ZERO) +
@@ -201,14 +270,14 @@ def get_term(chain: Chain, expi: Expi, config: pb.Config) -> pb.Expiration:
     x.call.target = float(call_target_strike)
 
     # Select candidate strikes.
-    put_closest_strike, index = get_closest_strike(expi.puts, put_target_strike)
+    put_closest_strike, index = get_closest_strike(expi.put_index, put_target_strike)
     x.put.strike = float(put_closest_strike)
 
     put_strike = expi.puts[index]
     if put_strike['bidSize'] < config.min_size or put_strike['askSize'] < config.min_size:
         x.diagnostics.append(
             f"WARNING: No size on puts ({put_strike['bidSize']} x {put_strike['askSize']})")
-    call_closest_strike, index = get_closest_strike(expi.calls, call_target_strike)
+    call_closest_strike, index = get_closest_strike(expi.call_index, call_target_strike)
     x.call.strike = float(call_closest_strike)
     call_strike = expi.calls[index]
     if call_strike['bidSize'] < config.min_size or call_strike['askSize'] < config.min_size:
@@ -253,24 +322,8 @@ def get_term(chain: Chain, expi: Expi, config: pb.Config) -> pb.Expiration:
     return x
 
 
-def analyze_earnings(chain_json: Json,
-                     config: pb.Config) -> pb.Earnings:
-    """Run the analysis on a single earnings name."""
-
-    # Store properties of the chain.
-    earnings = pb.Earnings()
-    chain = normalize_chain(chain_json)
-    earnings.underlying = chain.info['symbol']
-    earnings.name = get_company_description(chain)
-
-    # Store basic stats on the stock.
-    underlying = chain.info['underlying']
-    earnings.price = float(underlying['mark'])
-    earnings.year_high = float(underlying['fiftyTwoWeekHigh'])
-    earnings.year_low = float(underlying['fiftyTwoWeekLow'])
-    earnings.percent_change = float(underlying['percentChange'])
-    earnings.volume = int(underlying['totalVolume'])
-    earnings.quote_time = int(underlying['quoteTime'])
+def select_expirations(chain: Chain, config: pb.Config) -> list[Expi]:
+    """Select the expirations to analyze."""
 
     # Get data for the front term if non-regular.
     expi_list = []
@@ -284,25 +337,55 @@ def analyze_earnings(chain_json: Json,
             break
         expi_list.append(expi)
 
-    # Process each fo the expirations.
-    for expi in expi_list:
-        if expi is not None:
+    return expi_list
+
+
+def analyze_earnings(chain_json: Json,
+                     config: pb.Config,
+                     timings: Optional[timing.Timings] = None) -> pb.Earnings:
+    """Run the analysis on a single earnings name."""
+
+    # Store properties of the chain.
+    earnings = pb.Earnings()
+    symbol = chain_json['symbol']
+    with timing.optional_stage(timings, 'normalize', symbol):
+        chain = normalize_chain(chain_json)
+    with timing.optional_stage(timings, 'analyze', symbol):
+        earnings.underlying = chain.info['symbol']
+        earnings.name = get_company_description(chain)
+
+        # Store basic stats on the stock.
+        underlying = chain.info['underlying']
+        earnings.price = float(underlying['mark'])
+        earnings.year_high = float(underlying['fiftyTwoWeekHigh'])
+        earnings.year_low = float(underlying['fiftyTwoWeekLow'])
+        earnings.percent_change = float(underlying['percentChange'])
+        earnings.volume = int(underlying['totalVolume'])
+        earnings.quote_time = int(underlying['quoteTime'])
+
+        # Process each fo the expirations.
+        for expi in select_expirations(chain, config):
             earnings.expirations.append(get_term(chain, expi, config))
 
-    # Check volume.
-    if earnings.volume < config.volume_threshold:
-        earnings.diagnostics.append(
-            f"WARNING: Low volume (less than {config.volume_threshold})")
+        # Check volume.
+        if earnings.volume < config.volume_threshold:
+            earnings.diagnostics.append(
+                f"WARNING: Low volume (less than {config.volume_threshold})")
 
-    # Save the evaluation time.
-    earnings.evaluation_time = datetime.datetime.now().isoformat()
+        # Save the evaluation time.
+        earnings.evaluation_time = datetime.datetime.now().isoformat()
 
     return earnings
 
 
+def is_problem(message: str) -> bool:
+    """Return true if a diagnostic message is an error or a warning, not a note."""
+    return not message.startswith("INFO:")
+
+
 def is_tradeable(earnings: pb.Earnings):
     """Return true if this earnings name has some tradeable expirations."""
-    return (not earnings.diagnostics and
+    return (not any(map(is_problem, earnings.diagnostics)) and
             any(not expi.diagnostics for expi in earnings.expirations))
 
 
@@ -312,65 +395,104 @@ def get_url(name: str) -> str:
         urllib.parse.quote(get_clean_name(name)))
 
 
-def render_index_to_html(outfile: io.IOBase):
+@functools.lru_cache(maxsize=None)
+def get_environment() -> jinja2.Environment:
+    """Return the environment of the templates, created once per process. The
+    templates are compiled on first use and kept in memory, and their bytecode
+    is cached on disk for the next processes."""
+    env = jinja2.Environment(
+        loader=jinja2.PackageLoader("overnight", ""),
+        autoescape=jinja2.select_autoescape(),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(),
+        auto_reload=False)
+    env.globals['get_url'] = get_url
+    env.globals['get_clean_name'] = get_clean_name
+    return env
+
+
+def render_index_to_html(outfile: io.IOBase, timings: Optional[timing.Timings] = None,
+                         text: bool = False):
     """Render a single HTML file with all the earnings."""
 
     # Render the index template.
-    env = jinja2.Environment(
-        loader=jinja2.PackageLoader("overnight", ""),
-        autoescape=jinja2.select_autoescape())
-    index = env.get_template("index.html")
-    outfile.write(index.render(date=datetime.date.today()))
+    index = get_environment().get_template("index.html")
+    outfile.write(index.render(date=datetime.date.today(),
+                               text=text,
+                               wall=timings.get_wall() if timings else None,
+                               stages=timings.get_stages() if timings else [],
+                               slowest=timings.get_slowest() if timings else []))
 
 
 def render_earnings_to_html(earlist: pb.EarningsList,
                             evaluation_time: datetime.datetime,
-                            outfile: io.IOBase):
-    """Render a single HTML file with all the earnings."""
-
-    # Create an evaluation environment for the templates.
-    env = jinja2.Environment(
-        loader=jinja2.PackageLoader("overnight", ""),
-        autoescape=jinja2.select_autoescape())
-    env.globals['get_url'] = get_url
-    env.globals['get_clean_name'] = get_clean_name
+                            outfile: io.IOBase,
+                            prior_moves: Optional[Dict[str, List[moves.Move]]] = None):
+    """Render a single HTML file with all the earnings, and the realized moves
+    of their prior announcements if given."""
 
     # Render the index template. The output is a single HTML file.
-    index = env.get_template("overview.html")
+    index = get_environment().get_template("overview.html")
     outfile.write(index.render(earlist=earlist,
                                evaluation_time=evaluation_time,
+                               prior_moves=prior_moves or {},
                                date=datetime.date.today()))
 
 
 def render_files(symbols: List[str], config: pb.Config, earlist_all: pb.EarningsList,
-                 output_dir: str):
-    """Render all the output files to a directory."""
+                 output_dir: str, timings: Optional[timing.Timings] = None,
+                 text: bool = False,
+                 prior_moves: Optional[Dict[str, List[moves.Move]]] = None):
+    """Render all the output files to a directory. The results are saved in
+    binary, and also in text format if `text` is set."""
 
     # Create root dir.
     os.makedirs(output_dir, exist_ok=True)
 
-    # Save the input config.
-    with open(path.join(output_dir, "config.pbtxt"), "w") as outfile:
-        print(config, file=outfile)
+    with timing.optional_stage(timings, 'write'):
+        # Save the input config.
+        with open(path.join(output_dir, "config.pbtxt"), "w") as outfile:
+            print(config, file=outfile)
 
-    # Write out the evaluated data.
-    with open(path.join(output_dir, "earnings.pbtxt"), "w") as outfile:
-        print(earlist_all, file=outfile)
+        # Write out the evaluated data.
+        records.write_earnings(output_dir, earlist_all.earnings)
+        if text:
+            records.write_text(output_dir, earlist_all)
 
-    # Copy the input symbols.
-    with open(path.join(output_dir, "symbols-all.csv"), "w") as outfile:
-        wr = csv.writer(outfile)
-        wr.writerows([(symbol,) for symbol in symbols])
+        # Copy the input symbols.
+        with open(path.join(output_dir, "symbols-all.csv"), "w") as outfile:
+            wr = csv.writer(outfile)
+            wr.writerows([(symbol,) for symbol in symbols])
+
+    with timing.optional_stage(timings, 'render'):
+        render_pages(earlist_all, output_dir, prior_moves=prior_moves, text=text)
+
+    # Save the timings and render the index again to summarize them, now that
+    # all the stages are done.
+    if timings is not None:
+        timings.write(output_dir)
+        with open(path.join(output_dir, "index.html"), "w") as outfile:
+            render_index_to_html(outfile, timings, text)
+
+
+def render_pages(earlist_all: pb.EarningsList, output_dir: str,
+                 timings: Optional[timing.Timings] = None,
+                 prior_moves: Optional[Dict[str, List[moves.Move]]] = None,
+                 text: bool = False):
+    """Render the HTML pages and the watchlist for the given earnings. This may
+    be called repeatedly on partial lists, while a run is in progress. The index
+    links the text results only if `text` is set."""
 
     # Calculate evaluation time.
-    evaluation_time = (
-        parser.parse(max(earnings.evaluation_time
-                         for earnings in earlist_all.earnings))
-        .replace(microsecond=0))
+    times = [earnings.evaluation_time
+             for earnings in earlist_all.earnings
+             if earnings.evaluation_time]
+    evaluation_time = (parser.parse(max(times))
+                       if times
+                       else datetime.datetime.now()).replace(microsecond=0)
 
     # Render to a single HTML page.
     with open(path.join(output_dir, "earnings-all.html"), "w") as outfile:
-        render_earnings_to_html(earlist_all, evaluation_time, outfile)
+        render_earnings_to_html(earlist_all, evaluation_time, outfile, prior_moves)
 
     # Filter down the list to tradeable ones only and render to another page.
     earlist = pb.EarningsList()
@@ -378,7 +500,7 @@ def render_files(symbols: List[str], config: pb.Config, earlist_all: pb.Earnings
         if is_tradeable(earnings):
             earlist.earnings.append(earnings)
     with open(path.join(output_dir, "earnings.html"), "w") as outfile:
-        render_earnings_to_html(earlist, evaluation_time, outfile)
+        render_earnings_to_html(earlist, evaluation_time, outfile, prior_moves)
 
     # Produce a watchlist for import of just the tradeable names.
     with open(path.join(output_dir, "symbols.csv"), "w") as outfile:
@@ -388,25 +510,57 @@ def render_files(symbols: List[str], config: pb.Config, earlist_all: pb.Earnings
 
     # Render an index to all those files.
     with open(path.join(output_dir, "index.html"), "w") as outfile:
-        render_index_to_html(outfile)
-
-
-def fetch_chain(td: ameritrade.AmeritradeAPI, rate_limit, **kwargs):
-    """Fetch a chain, with poor man's handling of rate limits."""
-
-    # Fetch the option chain.
-    while True:
-        chain_json = td.GetOptionChain(**kwargs)
-
-        # Half-assed recovery from rate limit hit.
-        # TODO(blais): Properly handle this in the API code.
-        if rate_limit:
-            time.sleep(0.1)
-        if ('error' in chain_json and
-            re.search('transactions per seconds restriction reached',
-                      chain_json['error'])):
-            logging.warning("Rate-limit hit; throttling for 5 secs...")
-            time.sleep(5)
-            continue
-        break
-    return chain_json
+        render_index_to_html(outfile, timings, text)
+
+
+def is_valid_chain(chain_json: Json) -> bool:
+    """Return true if the response contains usable chain data."""
+    return chain_json.get('status') != 'FAILED' and 'callExpDateMap' in chain_json
+
+
+def fetch_chain(td: ameritrade.AmeritradeAPI,
+                limiter: Optional[ratelimit.TokenBucket],
+                policy: retry.RetryPolicy,
+                cache: Optional[cachelib.ChainCache] = None,
+                **kwargs) -> Tuple[Json, int]:
+    """Fetch a chain, throttled by the shared rate limiter and retrying failures.
+    Returns the chain and the number of retries it took."""
+    if cache is not None:
+        chain_json = cache.get(**kwargs)
+        if chain_json is not None:
+            return chain_json, 0
+    chain_json, retries = policy.call(limiter, td.GetOptionChain, **kwargs)
+    if cache is not None and is_valid_chain(chain_json):
+        cache.put(chain_json, **kwargs)
+    return chain_json, retries
+
+
+def fetch_chains(td: ameritrade.AmeritradeAPI,
+                 limiter: Optional[ratelimit.TokenBucket],
+                 policy: retry.RetryPolicy,
+                 symbols: List[str], jobs: int,
+                 cache: Optional[cachelib.ChainCache] = None,
+                 fetch: Callable[..., Tuple[Json, int]] = fetch_chain,
+                 **kwargs) -> Iterator[Tuple[str, Json, int]]:
+    """Fetch chains for a list of symbols using a bounded pool of threads.
+
+    This yields (symbol, chain, retries) triples in the same order as the input
+    list, regardless of the order in which the fetches complete, so that the
+    output list remains sorted. `fetch` has the signature of `fetch_chain`.
+    """
+    if jobs <= 1:
+        for symbol in symbols:
+            yield (symbol, *fetch(td, limiter, policy, cache, symbol=symbol, **kwargs))
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch, td, limiter, policy, cache,
+                                   symbol=symbol, **kwargs)
+                   for symbol in symbols]
+        try:
+            for symbol, future in zip(symbols, futures):
+                yield (symbol, *future.result())
+        finally:
+            # Don't leave pending fetches running if the consumer bails out.
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,143 @@
+"""Columnar export of the results of a run.
+
+The nested `pb.Earnings` messages are flattened into a table with one row per
+(underlying, expiration): the fields of the underlying, those of the
+expiration, and all the fields of its put and call `pb.Strike`, prefixed with
+'put_' and 'call_'. Columns are derived from the proto descriptors, so new
+fields show up without changes here. Tables are written as Parquet (or Arrow
+IPC) files, one per run, so a season of runs can be scanned as a dataset with
+pyarrow, DuckDB, Polars or pandas, e.g.
+
+  duckdb -c "SELECT * FROM 'earnings/*/terms.parquet' WHERE underlying = 'AAPL'"
+
+This requires pyarrow, which is optional.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import datetime
+
+from google.protobuf import descriptor
+
+from overnight import earnings_pb2 as pb
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Name of the table file in an output directory.
+TERMS_FILENAME = "terms.parquet"
+
+# Names of expiration columns which would be ambiguous as is.
+EXPIRATION_RENAMES = {'date': 'expiration',
+                      'diagnostics': 'expiration_diagnostics'}
+
+# Integer fields holding times, in milliseconds since the epoch.
+TIMESTAMP_FIELDS = {'quote_time'}
+
+# Fields of nested messages, flattened separately.
+NESTED_FIELDS = {'expirations', 'put', 'call'}
+
+FieldDescriptor = descriptor.FieldDescriptor
+
+# A column: its name, the descriptor of the field and a getter for its message.
+Column = Tuple[str, FieldDescriptor, Callable[[Tuple[Any, Any]], Any]]
+
+
+def get_columns() -> List[Column]:
+    """Return the columns of the table, in order."""
+    columns = []
+    for field in pb.Earnings.DESCRIPTOR.fields:
+        if field.name not in NESTED_FIELDS:
+            columns.append((field.name, field, lambda row: row[0]))
+    for field in pb.Expiration.DESCRIPTOR.fields:
+        if field.name not in NESTED_FIELDS:
+            columns.append((EXPIRATION_RENAMES.get(field.name, field.name), field,
+                            lambda row: row[1]))
+    for side in 'put', 'call':
+        for field in pb.Strike.DESCRIPTOR.fields:
+            columns.append((f"{side}_{field.name}", field,
+                            lambda row, side=side: getattr(row[1], side)))
+    return columns
+
+
+def get_value(msg: Any, field: FieldDescriptor) -> Any:
+    """Return the value of a field as a column value, None if unset."""
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return list(getattr(msg, field.name))
+    if not msg.HasField(field.name):
+        return None
+    value = getattr(msg, field.name)
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        return field.enum_type.values_by_number[value].name
+    if field.message_type is pb.Date.DESCRIPTOR:
+        return datetime.date(value.year, value.month, value.day)
+    return value
+
+
+def get_rows(earnings_iter: Iterable[pb.Earnings]) -> Iterator[Tuple[pb.Earnings, pb.Expiration]]:
+    """Flatten results to (underlying, expiration) pairs. Names without any
+    expiration (e.g. which failed) are left out."""
+    for earnings in earnings_iter:
+        for expiration in earnings.expirations:
+            yield earnings, expiration
+
+
+def get_arrow_type(name: str, field: FieldDescriptor) -> 'pyarrow.DataType':
+    """Return the Arrow type of a column."""
+    if name in TIMESTAMP_FIELDS:
+        dtype = pyarrow.timestamp('ms', tz='UTC')
+    elif field.message_type is pb.Date.DESCRIPTOR:
+        dtype = pyarrow.date32()
+    elif field.type == FieldDescriptor.TYPE_ENUM:
+        dtype = pyarrow.string()
+    else:
+        dtype = {FieldDescriptor.CPPTYPE_DOUBLE: pyarrow.float64(),
+                 FieldDescriptor.CPPTYPE_FLOAT: pyarrow.float32(),
+                 FieldDescriptor.CPPTYPE_INT64: pyarrow.int64(),
+                 FieldDescriptor.CPPTYPE_INT32: pyarrow.int32(),
+                 FieldDescriptor.CPPTYPE_BOOL: pyarrow.bool_(),
+                 FieldDescriptor.CPPTYPE_STRING: pyarrow.string()}[field.cpp_type]
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        dtype = pyarrow.list_(dtype)
+    return dtype
+
+
+def check_pyarrow():
+    """Fail if pyarrow is not installed."""
+    if pyarrow is None:
+        raise ImportError("The columnar export requires pyarrow (pip install pyarrow)")
+
+
+def to_table(earnings_iter: Iterable[pb.Earnings]) -> 'pyarrow.Table':
+    """Flatten results to an Arrow table."""
+    check_pyarrow()
+    columns = get_columns()
+    values: Dict[str, List[Any]] = {name: [] for name, _, _ in columns}
+    for row in get_rows(earnings_iter):
+        for name, field, getter in columns:
+            values[name].append(get_value(getter(row), field))
+    schema = pyarrow.schema([(name, get_arrow_type(name, field))
+                             for name, field, _ in columns])
+    return pyarrow.Table.from_pydict(values, schema=schema)
+
+
+def write_table(table: 'pyarrow.Table', filename: str):
+    """Write a table, as Arrow IPC for .arrow or .feather files, Parquet
+    otherwise."""
+    if path.splitext(filename)[1] in ('.arrow', '.feather'):
+        pyarrow.feather.write_feather(table, filename, compression='zstd')
+    else:
+        pyarrow.parquet.write_table(table, filename, compression='zstd')
+
+
+def write_terms(output_dir: str, earnings_iter: Iterable[pb.Earnings]):
+    """Write the table of results to an output directory."""
+    write_table(to_table(earnings_iter), path.join(output_dir, TERMS_FILENAME))
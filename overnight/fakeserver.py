@@ -0,0 +1,285 @@
+"""A local stand-in for the TD API over HTTP, and a client for it.
+
+The server answers the chain and quote endpoints from recorded snapshots or
+from synthetic data, with configurable latency, injected server errors and
+transient 'FAILED' chains, and TD's per-app rate limit, refusing requests over
+it with the same error body as the real service. This lets the fetch layer's
+concurrency, throttling and backoff be exercised and measured without an
+account.
+
+`HttpAmeritrade` is a minimal API object talking to it, decoding responses like
+the API library does.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+
+from overnight import chainjson
+from overnight import ratelimit
+from overnight import snapshot
+from overnight import synthetic
+
+
+Json = Dict[str, Any]
+
+# The body TD returns when an app exceeds its request rate.
+RATE_LIMIT_ERROR = {
+    "error": ("Individual App's transactions per seconds restriction reached. "
+              "Please contact us with further questions")
+}
+
+# The body of injected server errors.
+SERVER_ERROR = {"error": "Internal Server Error"}
+
+# TD's limit on the rate of requests per app, in requests per second.
+DEFAULT_SERVER_RATE = 2.0
+DEFAULT_SERVER_BURST = 120
+
+# Path prefix of the API endpoints.
+PREFIX = '/v1/marketdata'
+
+
+class SnapshotSource:
+    """Serve the chains recorded in snapshot archives, and quotes from them."""
+
+    def __init__(self, snapshot_dirs: List[str]):
+        self.documents = {}
+        for snapshot_dir in snapshot_dirs:
+            with zipfile.ZipFile(snapshot.get_filename(snapshot_dir)) as archive:
+                for name in archive.namelist():
+                    self.documents[name[:-len('.json')]] = archive.read(name)
+        self.options = {}
+        self.lock = threading.Lock()
+
+    def get_chain_data(self, symbol: str,
+                       to_date: Optional[datetime.date] = None) -> Optional[Json]:
+        data = self.documents.get(symbol)
+        if data is None:
+            return None
+        chain_data = json.loads(data)
+        if to_date is not None:
+            for field in 'callExpDateMap', 'putExpDateMap':
+                chain_data[field] = {
+                    key: strikes for key, strikes in chain_data.get(field, {}).items()
+                    if chainjson.parse_expiration_key(key) <= to_date}
+        return chain_data
+
+    def get_quote_data(self, symbol: str) -> Optional[Json]:
+        underlying, _, option_part = symbol.partition('_')
+        chain_data = self.get_chain_data(underlying)
+        if chain_data is None:
+            return None
+        if not option_part:
+            return synthetic.to_underlying_quote(chain_data['underlying'])
+        with self.lock:
+            if underlying not in self.options:
+                self.options[underlying] = {
+                    option['symbol']: option
+                    for field in ('callExpDateMap', 'putExpDateMap')
+                    for strikes in chain_data.get(field, {}).values()
+                    for datalist in strikes.values()
+                    for option in datalist}
+            option = self.options[underlying].get(symbol)
+        return synthetic.to_quote(option) if option is not None else None
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """An HTTP server standing in for the TD API.
+
+    `source` provides chains and quotes, with the methods of `SnapshotSource`.
+    Each request is delayed by `latency` seconds, plus up to `jitter` more. A
+    fraction `error_rate` of the requests fail with a server error, and a
+    fraction `failed_rate` of the chains come back with a 'FAILED' status.
+    Requests beyond `rate` per second (after a burst) get the rate-limit error.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], source: Any,
+                 latency: float = 0.,
+                 jitter: float = 0.,
+                 error_rate: float = 0.,
+                 failed_rate: float = 0.,
+                 rate: Optional[float] = DEFAULT_SERVER_RATE,
+                 burst: int = DEFAULT_SERVER_BURST):
+        super().__init__(address, RequestHandler)
+        self.source = source
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.failed_rate = failed_rate
+        self.limiter = ratelimit.TokenBucket(rate, burst) if rate else None
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{PREFIX}"
+
+    def count(self, name: str):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self) -> threading.Thread:
+        """Serve on a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle requests to the chain and quote endpoints."""
+
+    server: FakeServer
+
+    def log_message(self, format: str, *args):
+        logging.debug(format, *args)
+
+    def send_json(self, status: int, body: Any):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        server.count('requests')
+
+        if url.path == '/stats':
+            self.send_json(200, server.get_stats())
+            return
+        if not url.path.startswith(PREFIX):
+            server.count('not_found')
+            self.send_json(404, {"error": "Not Found"})
+            return
+        endpoint = url.path[len(PREFIX):]
+
+        # Refuse requests over the rate limit right away, like TD does.
+        if server.limiter is not None and not server.limiter.try_acquire():
+            server.count('throttled')
+            self.send_json(429, RATE_LIMIT_ERROR)
+            return
+
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        if random.random() < server.error_rate:
+            server.count('errors')
+            self.send_json(500, SERVER_ERROR)
+            return
+
+        if endpoint == '/chains':
+            self.send_json(200, self.get_chain(params))
+        elif endpoint == '/quotes':
+            self.send_json(200, self.get_quotes(params.get('symbol', '').split(',')))
+        elif endpoint.endswith('/quotes'):
+            self.send_json(200, self.get_quotes([endpoint.split('/')[1]]))
+        else:
+            server.count('not_found')
+            self.send_json(404, {"error": "Not Found"})
+
+    def get_chain(self, params: Dict[str, str]) -> Json:
+        server = self.server
+        symbol = params.get('symbol', '')
+        to_date = (datetime.date.fromisoformat(params['toDate'])
+                   if 'toDate' in params
+                   else None)
+        chain_data = server.source.get_chain_data(symbol, to_date)
+        if chain_data is None or random.random() < server.failed_rate:
+            server.count('failed')
+            return {"symbol": symbol, "status": "FAILED", "underlying": None,
+                    "strategy": "SINGLE", "callExpDateMap": {}, "putExpDateMap": {}}
+        if 'strikeCount' in params:
+            chain_data = synthetic.restrict_chain(chain_data, int(params['strikeCount']))
+        server.count('chains')
+        return chain_data
+
+    def get_quotes(self, symbols: List[str]) -> Json:
+        quotes = {}
+        for symbol in symbols:
+            quote = self.server.source.get_quote_data(symbol)
+            if quote is not None:
+                quotes[symbol] = quote
+        self.server.count('quotes')
+        return quotes
+
+
+def encode_param(value: Any) -> str:
+    """Encode a request parameter like the API library does."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y-%m-%d')
+    return str(value)
+
+
+class HttpAmeritrade:
+    """A minimal TD API object for the stand-in server.
+
+    Error responses are returned as their decoded bodies, so that the retry
+    and rate limiting logic sees them as it would with the API library.
+    """
+
+    def __init__(self, url: str, timeout: float = 30.):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, endpoint: str, **params) -> Any:
+        query = urllib.parse.urlencode({key: encode_param(value)
+                                        for key, value in params.items()})
+        try:
+            with urllib.request.urlopen(f"{self.url}{endpoint}?{query}",
+                                        timeout=self.timeout) as response:
+                return chainjson.loads(response.read())
+        except urllib.error.HTTPError as exc:
+            body = exc.read()
+            try:
+                return chainjson.loads(body)
+            except ValueError:
+                return {"error": f"HTTP {exc.code}: {body[:100]!r}"}
+
+    def GetOptionChain(self, **kwargs) -> Any:
+        return self.get('/chains', **kwargs)
+
+    def GetQuotes(self, symbol: str, **kwargs) -> Any:
+        return self.get('/quotes', symbol=symbol, **kwargs)
+
+    def GetQuote(self, symbol: str, **kwargs) -> Any:
+        return self.get(f'/{urllib.parse.quote(symbol)}/quotes', **kwargs)
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add options to run against a stand-in server to an argument parser."""
+    parser.add_argument('--fake-td', action='store',
+                        help=("Base URL of a stand-in TD server to call instead of the "
+                              "API (see overnight-fake-td)"))
+
+
+def api_from_args(args: argparse.Namespace) -> Optional[HttpAmeritrade]:
+    """Create a client for the stand-in server from parsed options, or None if
+    not requested."""
+    if not args.fake_td:
+        return None
+    return HttpAmeritrade(args.fake_td)
@@ -0,0 +1,206 @@
+"""A historical store of the results of runs.
+
+Runs are ingested into an SQLite database, append-only: each run is identified
+by its evaluation time, so ingesting the same results again does nothing, and a
+re-evaluation of a day is kept as a run of its own. There are three tables:
+
+- runs: one row per run, with its date and the directory it came from.
+- earnings: one row per underlying evaluated in a run, with the serialized
+  `pb.Earnings`, to recover the complete results.
+- terms: one row per (underlying, expiration) of a run, with the same flat
+  columns as the columnar export (see export.py), for queries.
+
+Lookups by symbol and date and by symbol and expiration are indexed.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+import datetime
+import json
+import os
+import sqlite3
+
+from dateutil import parser
+
+from overnight import earnings_pb2 as pb
+from overnight import export
+from overnight import records
+
+
+# Default location of the store, next to the output directories of the runs.
+DEFAULT_DATABASE = path.expanduser("~/p/overnight-data/earnings/history.db")
+
+# Columns of the terms table which precede the exported ones.
+TERMS_KEY_COLUMNS = ['run_id', 'date']
+
+# Columns of terms printed by default.
+DEFAULT_COLUMNS = ['date', 'underlying', 'expiration', 'days', 'is_regular',
+                   'em_effective', 'strangle_cr', 'atm_iv', 'put_strike', 'put_delta',
+                   'call_strike', 'call_delta']
+
+
+def get_sql_type(field: export.FieldDescriptor) -> str:
+    """Return the SQL type of an exported column."""
+    if (field.label == export.FieldDescriptor.LABEL_REPEATED or
+        field.type in (export.FieldDescriptor.TYPE_ENUM, export.FieldDescriptor.TYPE_MESSAGE)):
+        return 'TEXT'
+    return {export.FieldDescriptor.CPPTYPE_DOUBLE: 'REAL',
+            export.FieldDescriptor.CPPTYPE_FLOAT: 'REAL',
+            export.FieldDescriptor.CPPTYPE_STRING: 'TEXT'}.get(field.cpp_type, 'INTEGER')
+
+
+def to_sql_value(value: Any) -> Any:
+    """Convert an exported column value to an SQLite one."""
+    if isinstance(value, list):
+        return json.dumps(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def get_schema() -> str:
+    """Return the statements creating the tables and their indexes."""
+    columns = ",\n  ".join(f"{name} {get_sql_type(field)}"
+                           for name, field, _ in export.get_columns())
+    return f"""
+CREATE TABLE IF NOT EXISTS runs (
+  run_id INTEGER PRIMARY KEY,
+  evaluation_time TEXT UNIQUE NOT NULL,
+  date TEXT NOT NULL,
+  output_dir TEXT,
+  ingested TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS earnings (
+  run_id INTEGER NOT NULL REFERENCES runs(run_id),
+  date TEXT NOT NULL,
+  underlying TEXT NOT NULL,
+  success INTEGER,
+  data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+  run_id INTEGER NOT NULL REFERENCES runs(run_id),
+  date TEXT NOT NULL,
+  {columns}
+);
+CREATE INDEX IF NOT EXISTS earnings_underlying ON earnings(underlying, date);
+CREATE INDEX IF NOT EXISTS terms_underlying ON terms(underlying, date);
+CREATE INDEX IF NOT EXISTS terms_expiration ON terms(underlying, expiration);
+CREATE INDEX IF NOT EXISTS terms_date ON terms(date);
+"""
+
+
+def connect(filename: str = DEFAULT_DATABASE) -> sqlite3.Connection:
+    """Open the store, creating it if needed."""
+    os.makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(get_schema())
+    return conn
+
+
+def get_evaluation_time(earnings_list: List[pb.Earnings]) -> Optional[datetime.datetime]:
+    """Return the time a run was evaluated at, that of its latest result."""
+    times = [earnings.evaluation_time
+             for earnings in earnings_list
+             if earnings.evaluation_time]
+    return parser.parse(max(times)) if times else None
+
+
+def ingest(conn: sqlite3.Connection, earnings_iter: Iterable[pb.Earnings],
+           output_dir: Optional[str] = None) -> Optional[int]:
+    """Add the results of a run to the store. Return the id of the new run, or
+    None if it was there already or had no results."""
+    earnings_list = list(earnings_iter)
+    evaluation_time = get_evaluation_time(earnings_list)
+    if evaluation_time is None:
+        return None
+    date = evaluation_time.date().isoformat()
+    columns = export.get_columns()
+    with conn:
+        try:
+            cursor = conn.execute(
+                "INSERT INTO runs (evaluation_time, date, output_dir, ingested) "
+                "VALUES (?, ?, ?, ?)",
+                (evaluation_time.isoformat(), date,
+                 path.abspath(output_dir) if output_dir else None,
+                 datetime.datetime.now().isoformat()))
+        except sqlite3.IntegrityError:
+            return None
+        run_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO earnings (run_id, date, underlying, success, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(run_id, date, earnings.underlying, earnings.success,
+              earnings.SerializeToString())
+             for earnings in earnings_list])
+        names = ", ".join(TERMS_KEY_COLUMNS + [name for name, _, _ in columns])
+        params = ", ".join("?" * (len(TERMS_KEY_COLUMNS) + len(columns)))
+        conn.executemany(
+            f"INSERT INTO terms ({names}) VALUES ({params})",
+            [[run_id, date] + [to_sql_value(export.get_value(getter(row), field))
+                               for _, field, getter in columns]
+             for row in export.get_rows(earnings_list)])
+    return run_id
+
+
+def ingest_directory(conn: sqlite3.Connection, output_dir: str) -> Optional[int]:
+    """Add the results of the run in an output directory to the store."""
+    return ingest(conn, records.read_earnings(output_dir), output_dir)
+
+
+def get_conditions(symbol: Optional[str] = None,
+                   since: Optional[datetime.date] = None,
+                   until: Optional[datetime.date] = None,
+                   expiration: Optional[datetime.date] = None) -> Tuple[str, List[Any]]:
+    """Return a WHERE clause and its parameters for a lookup."""
+    conditions, params = [], []
+    if symbol:
+        conditions.append("underlying = ?")
+        params.append(symbol)
+    if since:
+        conditions.append("date >= ?")
+        params.append(since.isoformat())
+    if until:
+        conditions.append("date <= ?")
+        params.append(until.isoformat())
+    if expiration:
+        conditions.append("expiration = ?")
+        params.append(expiration.isoformat())
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+
+def query_terms(conn: sqlite3.Connection, columns: List[str] = DEFAULT_COLUMNS,
+                **kwargs) -> List[sqlite3.Row]:
+    """Return the terms of past runs, e.g. for a symbol between two dates."""
+    known = set(TERMS_KEY_COLUMNS) | {name for name, _, _ in export.get_columns()}
+    unknown = set(columns) - known
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    where, params = get_conditions(**kwargs)
+    return conn.execute(
+        f"SELECT {', '.join(columns)} FROM terms {where} "
+        "ORDER BY date, run_id, underlying, expiration", params).fetchall()
+
+
+def query_earnings(conn: sqlite3.Connection,
+                   symbol: Optional[str] = None,
+                   since: Optional[datetime.date] = None,
+                   until: Optional[datetime.date] = None) -> Iterator[pb.Earnings]:
+    """Return the complete results of past runs, e.g. for a symbol."""
+    where, params = get_conditions(symbol, since, until)
+    for row in conn.execute(f"SELECT data FROM earnings {where} "
+                            "ORDER BY date, run_id, underlying", params):
+        yield pb.Earnings.FromString(row['data'])
+
+
+def query_runs(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    """Return the runs in the store, with their number of names and terms."""
+    return conn.execute("""
+      SELECT runs.run_id, runs.date, runs.evaluation_time, runs.output_dir,
+             (SELECT COUNT(*) FROM earnings WHERE earnings.run_id = runs.run_id) AS names,
+             (SELECT COUNT(*) FROM terms WHERE terms.run_id = runs.run_id) AS terms
+      FROM runs ORDER BY runs.evaluation_time
+    """).fetchall()
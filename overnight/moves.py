@@ -0,0 +1,216 @@
+"""Realized moves across past earnings announcements.
+
+Each name evaluated by a run in the historical store (see history.py) is taken
+to announce between the close of the run's date and the open of the next
+trading day (AMC that day, or BMO the next). Its realized overnight move is
+the gap between those two prices, which is compared to the effective expected
+move of its nearest expiration which has one at the time, as a fraction of the
+price:
+
+  ratio = |open / close - 1| / (em_effective / price)
+
+A ratio above 1 means the name moved more than the options priced in.
+
+Daily prices are fetched from the API and cached in the store, so that only
+the announcements which have not been processed yet cost anything: each
+update looks for pending (name, date) pairs, fetches the prices of those
+names from their earliest pending date on, and records their moves. Pairs
+which still have no prices after a while (e.g. delisted names) are recorded
+without a move, so they are not retried forever.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import collections
+import datetime
+import logging
+import sqlite3
+
+from overnight import ratelimit
+from overnight import retry
+
+
+# Number of days after which an announcement without prices is given up on.
+MAX_PENDING_DAYS = 10
+
+# Default number of prior moves shown per name.
+DEFAULT_NUM_MOVES = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prices (
+  symbol TEXT NOT NULL,
+  date TEXT NOT NULL,
+  open REAL,
+  high REAL,
+  low REAL,
+  close REAL,
+  volume INTEGER,
+  PRIMARY KEY (symbol, date)
+);
+CREATE TABLE IF NOT EXISTS moves (
+  underlying TEXT NOT NULL,
+  date TEXT NOT NULL,
+  close REAL,
+  next_date TEXT,
+  next_open REAL,
+  move REAL,
+  em_frac REAL,
+  ratio REAL,
+  PRIMARY KEY (underlying, date)
+);
+"""
+
+
+class Event(NamedTuple):
+    """An announcement evaluated by a past run, pending its realized move."""
+    underlying: str
+    date: datetime.date
+    price: Optional[float]
+    em_effective: Optional[float]
+
+
+class Move(NamedTuple):
+    """The realized move of a past announcement."""
+    date: datetime.date
+    move: float
+    ratio: Optional[float]
+
+
+def create_tables(conn: sqlite3.Connection):
+    """Create the tables of prices and moves in the store, if needed."""
+    conn.executescript(SCHEMA)
+
+
+def get_pending(conn: sqlite3.Connection, today: datetime.date) -> List[Event]:
+    """Return the announcements before today without a recorded move. Re-runs
+    of the same day use the latest run, and the nearest expiration with an
+    expected move (the nearest ones fail to get one at times)."""
+    rows = conn.execute("""
+      SELECT run_id, underlying, date, price, em_effective FROM terms
+      WHERE date < ? AND NOT EXISTS (
+        SELECT 1 FROM moves
+        WHERE moves.underlying = terms.underlying AND moves.date = terms.date)
+      ORDER BY underlying, date, run_id DESC, days
+    """, (today.isoformat(),))
+    events, run_ids = {}, {}
+    for row in rows:
+        key = (row['underlying'], row['date'])
+        if key in events and (run_ids[key] != row['run_id'] or events[key].em_effective):
+            continue
+        if key not in events or row['em_effective']:
+            events[key] = Event(row['underlying'], datetime.date.fromisoformat(row['date']),
+                                row['price'], row['em_effective'])
+            run_ids[key] = row['run_id']
+    return list(events.values())
+
+
+def parse_candles(response: Any) -> List[Tuple[str, Any, Any, Any, Any, Any]]:
+    """Convert a price history response to rows of the prices table. Daily
+    candles are timestamped at midnight Central time, on the date in UTC."""
+    rows = []
+    for candle in response.get('candles', []):
+        date = datetime.datetime.fromtimestamp(int(candle['datetime']) / 1000,
+                                               datetime.timezone.utc).date()
+        rows.append((date.isoformat(),
+                     float(candle['open']), float(candle['high']),
+                     float(candle['low']), float(candle['close']),
+                     int(candle['volume'])))
+    return rows
+
+
+def fetch_prices(conn: sqlite3.Connection, td: Any,
+                 limiter: Optional[ratelimit.TokenBucket], policy: retry.RetryPolicy,
+                 symbol: str, start: datetime.date, end: datetime.date):
+    """Fetch the daily prices of a symbol over a range of dates into the store."""
+    def to_millis(date: datetime.date) -> int:
+        return int(datetime.datetime(date.year, date.month, date.day,
+                                     tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    response, _ = policy.call(limiter, td.GetPriceHistory, symbol=symbol,
+                              periodType='month', frequencyType='daily', frequency=1,
+                              startDate=to_millis(start),
+                              endDate=to_millis(end + datetime.timedelta(days=1)))
+    rows = parse_candles(response)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO prices (symbol, date, open, high, low, close, volume) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(symbol,) + row for row in rows])
+
+
+def get_move(conn: sqlite3.Connection, event: Event) -> Optional[Tuple]:
+    """Return the row of the moves table for an announcement from the cached
+    prices, or None if they are not there yet."""
+    close = conn.execute("SELECT close FROM prices WHERE symbol = ? AND date = ?",
+                         (event.underlying, event.date.isoformat())).fetchone()
+    following = conn.execute(
+        "SELECT date, open FROM prices WHERE symbol = ? AND date > ? ORDER BY date LIMIT 1",
+        (event.underlying, event.date.isoformat())).fetchone()
+    if close is None or following is None or not close['close']:
+        return None
+    move = following['open'] / close['close'] - 1
+    em_frac = (event.em_effective / event.price
+               if event.em_effective and event.price
+               else None)
+    ratio = abs(move) / em_frac if em_frac else None
+    return (event.underlying, event.date.isoformat(), close['close'],
+            following['date'], following['open'], move, em_frac, ratio)
+
+
+def update(conn: sqlite3.Connection, td: Any,
+           limiter: Optional[ratelimit.TokenBucket], policy: retry.RetryPolicy,
+           today: Optional[datetime.date] = None) -> int:
+    """Record the moves of the announcements processed since the last update,
+    fetching the prices missing from the cache. Return the number of moves
+    recorded."""
+    today = today or datetime.date.today()
+    create_tables(conn)
+    by_symbol = collections.defaultdict(list)
+    for event in get_pending(conn, today):
+        by_symbol[event.underlying].append(event)
+    logging.info(f"{sum(map(len, by_symbol.values()))} pending announcements "
+                 f"for {len(by_symbol)} names")
+
+    num_moves = 0
+    for symbol, events in sorted(by_symbol.items()):
+        rows = [get_move(conn, event) for event in events]
+        if any(row is None for row in rows):
+            start = min(event.date for event, row in zip(events, rows) if row is None)
+            try:
+                fetch_prices(conn, td, limiter, policy, symbol, start, today)
+            except Exception as exc:
+                logging.warning(f"Could not fetch prices for {symbol}: {exc}")
+            rows = [row or get_move(conn, event) for event, row in zip(events, rows)]
+
+        # Give up on the old ones still missing prices.
+        cutoff = today - datetime.timedelta(days=MAX_PENDING_DAYS)
+        rows = [row or ((event.underlying, event.date.isoformat()) + (None,) * 6
+                        if event.date < cutoff
+                        else None)
+                for event, row in zip(events, rows)]
+        rows = [row for row in rows if row is not None]
+        with conn:
+            conn.executemany("INSERT INTO moves VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        num_moves += len(rows)
+    return num_moves
+
+
+def get_prior_moves(conn: sqlite3.Connection, symbols: Iterable[str],
+                    before: Optional[datetime.date] = None,
+                    num_moves: int = DEFAULT_NUM_MOVES) -> Dict[str, List[Move]]:
+    """Return the latest realized moves of names, most recent first."""
+    before = before or datetime.date.today()
+    create_tables(conn)
+    moves = {}
+    for symbol in symbols:
+        rows = conn.execute(
+            "SELECT date, move, ratio FROM moves "
+            "WHERE underlying = ? AND date < ? AND move IS NOT NULL "
+            "ORDER BY date DESC LIMIT ?",
+            (symbol, before.isoformat(), num_moves)).fetchall()
+        if rows:
+            moves[symbol] = [Move(datetime.date.fromisoformat(row['date']),
+                                  row['move'], row['ratio'])
+                             for row in rows]
+    return moves
@@ -0,0 +1,86 @@
+"""Fetch only the part of a chain the analysis looks at.
+
+The analysis only ever uses the strikes around the money and those near a
+multiple of the expected move. Wide chains have hundreds of strikes per
+expiration, most of which are discarded. This fetches a chain in two phases:
+first a probe with a few strikes around the money, enough to estimate the
+expected move and the strike spacing of each term; then the chain restricted
+to the number of strikes covering the strangle width (with a margin) and to
+the candidate expirations.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Optional, Tuple
+import datetime
+import logging
+import math
+
+import ameritrade
+
+from overnight import cache as cachelib
+from overnight import earnings_pb2 as pb
+from overnight import evaluate
+from overnight import ratelimit
+from overnight import retry
+
+
+Json = evaluate.Json
+
+# Number of strikes requested around the money in the probe.
+PROBE_STRIKES = 8
+
+# Extra strikes requested on each side beyond the estimated strangle width, to
+# absorb the difference between the probe and final estimates.
+MARGIN_STRIKES = 3
+
+
+def get_strike_count(chain_json: Json,
+                     config: pb.Config) -> Optional[Tuple[int, datetime.date]]:
+    """Compute the number of strikes and the last expiration date to request
+    from a probe chain. Returns None if this can't be estimated."""
+    chain = evaluate.normalize_chain(chain_json)
+    if not chain.expis:
+        return None
+    num_strikes = 0
+    last_date = None
+    for expi in evaluate.select_expirations(chain, config):
+        term = evaluate.get_term(chain, expi, config)
+        prices = expi.call_index.prices
+        if not term.HasField('em_effective') or len(prices) < 2:
+            return None
+        spacing = min(float(high - low) for low, high in zip(prices, prices[1:]))
+        width = config.strangle_em_width * term.em_effective
+        num_strikes = max(num_strikes, math.ceil(width / spacing) + MARGIN_STRIKES)
+        last_date = expi.info['expiration']
+    if last_date is None:
+        return None
+    # The count covers both sides of the money.
+    return 2 * num_strikes + 1, last_date
+
+
+def fetch_narrow_chain(td: ameritrade.AmeritradeAPI,
+                       limiter: Optional[ratelimit.TokenBucket],
+                       policy: retry.RetryPolicy,
+                       cache: Optional[cachelib.ChainCache] = None,
+                       *,
+                       config: pb.Config,
+                       **kwargs) -> Tuple[Json, int]:
+    """Fetch a chain narrowed to the strikes and terms the analysis needs. This
+    falls back on the full chain if the probe is not conclusive."""
+    probe_json, probe_retries = evaluate.fetch_chain(td, limiter, policy, cache,
+                                                     strikeCount=PROBE_STRIKES, **kwargs)
+    if not evaluate.is_valid_chain(probe_json):
+        return probe_json, probe_retries
+
+    narrowing = get_strike_count(probe_json, config)
+    if narrowing is None:
+        logging.info(f"Could not narrow chain for {kwargs.get('symbol')}")
+        chain_json, retries = evaluate.fetch_chain(td, limiter, policy, cache, **kwargs)
+    else:
+        strike_count, last_date = narrowing
+        kwargs['toDate'] = last_date
+        chain_json, retries = evaluate.fetch_chain(td, limiter, policy, cache,
+                                                   strikeCount=strike_count, **kwargs)
+    return chain_json, probe_retries + retries
@@ -0,0 +1,231 @@
+"""Profiling of the command-line tools.
+
+Two kinds of profiles are supported:
+
+- 'cprofile': a deterministic profile of every function call, saved in the
+  standard pstats format (for pstats, snakeviz, gprof2dot, etc.). cProfile
+  only sees the thread it is enabled on, so a profiler is also installed on
+  each thread started during the run (e.g. the fetch threads of --jobs), and
+  their profiles are merged.
+
+- 'sample': a statistical profile, sampling the stacks of all the threads at a
+  fixed interval, saved as folded stacks (the format py-spy and flamegraph.pl
+  produce and speedscope reads). Its overhead is low enough for production
+  runs.
+
+Either way, a summary of the top functions can be printed at the end. Worker
+processes of the analysis pool are not included.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Iterator, Optional, Tuple
+import argparse
+import collections
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+
+import click
+
+
+# Names of the profile files in an output directory, by mode.
+PROFILE_FILENAMES = {'cprofile': "profile.prof",
+                     'sample': "profile.folded"}
+
+# Directory profiles are saved to by tools without an output directory.
+DEFAULT_PROFILE_DIR = path.expanduser("~/p/overnight-data/profiles")
+
+# Default interval between samples, in seconds.
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Default number of functions printed in the summary.
+DEFAULT_TOP = 25
+
+
+def get_frame_name(frame) -> str:
+    """Return a name identifying the function of a frame."""
+    code = frame.f_code
+    return f"{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Sample the stacks of all the threads on a background thread."""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampler', daemon=True)
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(get_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, filename: str):
+        """Write the samples as folded stacks."""
+        with open(filename, 'w') as outfile:
+            for stack, count in sorted(self.stacks.items()):
+                outfile.write(f"{';'.join(stack)} {count}\n")
+
+    def format_top(self, num: int) -> str:
+        """Format the functions with the most samples, on and under them."""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack[1:]):
+                total[name] += count
+        num_samples = sum(self.stacks.values()) or 1
+        lines = [f"{num_samples} samples", f"{'own %':>7} {'total %':>7}  function"]
+        for name, count in own.most_common(num):
+            lines.append(f"{count / num_samples:7.1%} {total[name] / num_samples:7.1%}  {name}")
+        return "\n".join(lines)
+
+
+class ThreadProfiler:
+    """A cProfile profiler for the current thread and the threads it starts."""
+
+    def __init__(self):
+        self.profilers = [cProfile.Profile()]
+        self.lock = threading.Lock()
+
+    def start_thread(self, frame, event, arg):
+        # Called on the first event of a new thread; replaces itself.
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+    def enable(self):
+        threading.setprofile(self.start_thread)
+        self.profilers[0].enable()
+
+    def disable(self):
+        self.profilers[0].disable()
+        threading.setprofile(None)
+
+    def get_stats(self, stream: Optional[io.TextIOBase] = None) -> pstats.Stats:
+        """Return the merged stats of all the threads."""
+        with self.lock:
+            profilers = list(self.profilers)
+        stats = pstats.Stats(profilers[0], stream=stream)
+        for profiler in profilers[1:]:
+            profiler.create_stats()
+            if profiler.stats:
+                stats.add(profiler)
+        return stats
+
+
+@contextlib.contextmanager
+def profile(mode: Optional[str], filename: Optional[str] = None,
+            top: int = 0) -> Iterator[None]:
+    """Profile the body of a with-statement, if a mode is given. The profile is
+    saved to a file and the top functions are printed to stderr."""
+    if mode is None:
+        yield
+        return
+    if mode == 'cprofile':
+        profiler = ThreadProfiler()
+        profiler.enable()
+    else:
+        profiler = Sampler()
+        profiler.start()
+    try:
+        yield
+    finally:
+        if mode == 'cprofile':
+            profiler.disable()
+            summary = io.StringIO()
+            stats = profiler.get_stats(summary)
+        else:
+            profiler.stop()
+        if filename:
+            os.makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+            if mode == 'cprofile':
+                stats.dump_stats(filename)
+            else:
+                profiler.write(filename)
+            print(f"Profile written to {filename}", file=sys.stderr)
+        if top:
+            if mode == 'cprofile':
+                stats.sort_stats('cumulative').print_stats(top)
+                print(summary.getvalue(), file=sys.stderr)
+            else:
+                print(profiler.format_top(top), file=sys.stderr)
+
+
+def get_filename(mode: Optional[str], filename: Optional[str],
+                 output_dir: Optional[str]) -> Optional[str]:
+    """Return the file to save a profile to, in the output directory (or the
+    default profile directory) unless specified."""
+    if mode is None or filename:
+        return filename
+    return path.join(output_dir or DEFAULT_PROFILE_DIR, PROFILE_FILENAMES[mode])
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add profiling options to an argument parser."""
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile the run (see --profile-mode)")
+    parser.add_argument('--profile-mode', action='store', default='cprofile',
+                        choices=list(PROFILE_FILENAMES),
+                        help=("Profile deterministically ('cprofile', the default) or "
+                              "by sampling stacks ('sample')"))
+    parser.add_argument('--profile-output', action='store',
+                        help=("File to save the profile to (default: profile.prof or "
+                              "profile.folded in the output directory, or in "
+                              f"{DEFAULT_PROFILE_DIR})"))
+    parser.add_argument('--profile-top', action='store', type=int, default=0,
+                        help=("Print a summary of this many top functions at the end "
+                              f"(e.g. {DEFAULT_TOP})"))
+
+
+def profile_from_args(args: argparse.Namespace, output_dir: Optional[str] = None):
+    """Return a profiling context for parsed options."""
+    mode = args.profile_mode if args.profile else None
+    return profile(mode, get_filename(mode, args.profile_output, output_dir),
+                   args.profile_top)
+
+
+def click_options(func):
+    """Add the profiling options to a click command."""
+    options = [
+        click.option('--profile', is_flag=True,
+                     help="Profile the run (see --profile-mode)"),
+        click.option('--profile-mode', type=click.Choice(list(PROFILE_FILENAMES)),
+                     default='cprofile',
+                     help=("Profile deterministically ('cprofile', the default) or "
+                           "by sampling stacks ('sample')")),
+        click.option('--profile-output',
+                     help=("File to save the profile to (default: profile.prof or "
+                           f"profile.folded in {DEFAULT_PROFILE_DIR})")),
+        click.option('--profile-top', type=int, default=0,
+                     help="Print a summary of this many top functions at the end"),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
@@ -0,0 +1,103 @@
+"""Client-side rate limiting for the TD API."""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Optional
+import argparse
+import re
+import threading
+import time
+
+
+# Default sustained rate of requests to the TD API. Their documented limit is
+# 120 requests per minute.
+DEFAULT_RATE = 2.0
+
+# Default number of requests that may be issued back-to-back.
+DEFAULT_BURST = 4
+
+
+class TokenBucket:
+    """A thread-safe token bucket, shared by all the threads calling the API.
+
+    Tokens accumulate at `rate` per second, up to `burst` of them. Each request
+    consumes one token, blocking until one is available.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        if not rate > 0:
+            raise ValueError(f"Rate must be positive: {rate}")
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """Add the tokens accumulated since the last update. Hold the lock."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Take a single token, sleeping until one becomes available."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """Take a single token if one is available, without waiting."""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def drain(self):
+        """Empty the bucket. Call this when the server says we're over the limit."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.)
+
+
+def is_rate_limited(response: Any) -> bool:
+    """Return true if the response is the TD API's rate-limit refusal."""
+    return bool(isinstance(response, dict) and
+                'error' in response and
+                re.search('transactions per seconds restriction reached',
+                          str(response['error'])))
+
+
+def positive_float(value: str) -> float:
+    """Parse a positive number option."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value!r}")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be positive: {value!r}")
+    return number
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add rate limiting options to an argument parser."""
+    parser.add_argument('-r', '--rate-limit', action='store_true',
+                        help="Limit the rate of requests (see --rate)")
+    parser.add_argument('--rate', action='store', type=positive_float, default=DEFAULT_RATE,
+                        help="Number of requests per second allowed under the limit")
+    parser.add_argument('--rate-burst', action='store', type=int, default=DEFAULT_BURST,
+                        help="Number of requests allowed back-to-back under the limit")
+
+
+def limiter_from_args(args: argparse.Namespace) -> Optional[TokenBucket]:
+    """Create a shared limiter from parsed options, or None if unlimited."""
+    if not args.rate_limit:
+        return None
+    return TokenBucket(args.rate, args.rate_burst)
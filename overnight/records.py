@@ -0,0 +1,115 @@
+"""Files of binary earnings records.
+
+Results are stored as a sequence of length-delimited `pb.Earnings` messages (a
+varint size followed by the serialized message, the same framing as Java's
+writeDelimitedTo()). This is much smaller and faster to load than the text
+format, and can be written and read one record at a time. The text format is
+only produced on demand, for reading by eye.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import BinaryIO, Iterable, Iterator, Type, TypeVar
+import os
+
+from google.protobuf import message
+from google.protobuf import text_format
+
+from overnight import earnings_pb2 as pb
+
+
+# Name of the results file in an output directory.
+EARNINGS_FILENAME = "earnings.delimited.pb"
+
+# Name of the text rendering of the results, and of older runs' results.
+TEXT_FILENAME = "earnings.pbtxt"
+
+
+Message = TypeVar('Message', bound=message.Message)
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode an unsigned integer as a protobuf varint."""
+    parts = []
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            parts.append(bits | 0x80)
+        else:
+            parts.append(bits)
+            return bytes(parts)
+
+
+def read_varint(infile: BinaryIO) -> int:
+    """Read a protobuf varint from a file. Return -1 at the end of the file."""
+    value = 0
+    shift = 0
+    while True:
+        byte = infile.read(1)
+        if not byte:
+            if shift:
+                raise EOFError("Truncated varint")
+            return -1
+        value |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+def write_delimited(outfile: BinaryIO, msg: message.Message):
+    """Append a length-delimited message to a file."""
+    data = msg.SerializeToString()
+    outfile.write(encode_varint(len(data)))
+    outfile.write(data)
+
+
+def read_delimited(infile: BinaryIO, message_type: Type[Message]) -> Iterator[Message]:
+    """Read all the length-delimited messages of a file."""
+    while True:
+        size = read_varint(infile)
+        if size < 0:
+            return
+        data = infile.read(size)
+        if len(data) != size:
+            raise EOFError("Truncated message")
+        yield message_type.FromString(data)
+
+
+def get_filename(output_dir: str) -> str:
+    """Return the results file in an output directory. Accept the file itself too."""
+    return (output_dir
+            if path.isfile(output_dir)
+            else path.join(output_dir, EARNINGS_FILENAME))
+
+
+def write_earnings(output_dir: str, earnings_iter: Iterable[pb.Earnings]):
+    """Write the results file of an output directory, replacing it atomically."""
+    filename = path.join(output_dir, EARNINGS_FILENAME)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'wb') as outfile:
+        for earnings in earnings_iter:
+            write_delimited(outfile, earnings)
+    os.replace(tmp_filename, filename)
+
+
+def read_earnings(output_dir: str) -> Iterator[pb.Earnings]:
+    """Read the results of an output directory, one at a time. Runs from before
+    the binary format have only the text file; read that instead."""
+    filename = get_filename(output_dir)
+    if not path.exists(filename) and path.isdir(output_dir):
+        text_filename = path.join(output_dir, TEXT_FILENAME)
+        if path.exists(text_filename):
+            with open(text_filename) as infile:
+                yield from text_format.Parse(infile.read(), pb.EarningsList()).earnings
+            return
+    with open(filename, 'rb') as infile:
+        yield from read_delimited(infile, pb.Earnings)
+
+
+def write_text(output_dir: str, earlist: pb.EarningsList):
+    """Write the text rendering of the results to an output directory."""
+    with open(path.join(output_dir, TEXT_FILENAME), "w") as outfile:
+        print(earlist, file=outfile)
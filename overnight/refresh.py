@@ -0,0 +1,188 @@
+"""Refresh the quotes of stored chains without refetching them.
+
+Strikes and expirations don't change during the day, so re-checking names
+before the close only requires updated markets on the handful of options the
+analysis looks at: the ATM strikes used to estimate the expected move and the
+strikes selected for the strangle (with a neighbor on each side, in case the
+move shifts). This fetches quotes for those options only, in large batches,
+and patches them into the stored chains.
+
+If the underlying moves enough that the analysis of a patched chain selects
+other strikes, their quotes are fetched in a second round. Names which still
+depend on markets that could not be refreshed (e.g. a failed batch) get a
+warning diagnostic, stored in the chain under DIAGNOSTICS_FIELD, so that they
+are not mistaken for fresh ones.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from decimal import Decimal
+from typing import Iterator, List, Optional, Tuple
+import logging
+
+import ameritrade
+
+from overnight import earnings_pb2 as pb
+from overnight import evaluate
+from overnight import ratelimit
+from overnight import retry
+
+
+Json = evaluate.Json
+
+# Maximum number of symbols to request quotes for at once.
+MAX_QUOTES_PER_REQUEST = 200
+
+# Field of the chains where refresh problems are recorded.
+DIAGNOSTICS_FIELD = 'refreshDiagnostics'
+
+# Maximum number of stale symbols listed in a diagnostic.
+MAX_LISTED_SYMBOLS = 5
+
+# Mapping of chain option fields to their quote fields.
+OPTION_FIELDS = [('bid', 'bidPrice'),
+                 ('ask', 'askPrice'),
+                 ('last', 'lastPrice'),
+                 ('mark', 'mark'),
+                 ('bidSize', 'bidSize'),
+                 ('askSize', 'askSize'),
+                 ('delta', 'delta'),
+                 ('volatility', 'volatility'),
+                 ('totalVolume', 'totalVolume'),
+                 ('openInterest', 'openInterest')]
+
+# Mapping of chain underlying fields to their quote fields.
+UNDERLYING_FIELDS = [('bid', 'bidPrice'),
+                     ('ask', 'askPrice'),
+                     ('last', 'lastPrice'),
+                     ('mark', 'mark'),
+                     ('totalVolume', 'totalVolume'),
+                     ('percentChange', 'netPercentChangeInDouble'),
+                     ('quoteTime', 'quoteTimeInLong')]
+
+
+def get_nearby(strikes: list[evaluate.StrikeData], index: int, offsets: range) -> List[str]:
+    """Return the option symbols at the given offsets from an index."""
+    return [strikes[index + offset]['symbol']
+            for offset in offsets
+            if 0 <= index + offset < len(strikes)]
+
+
+def get_quote_symbols(chain_json: Json, config: pb.Config) -> List[str]:
+    """Return the option symbols the analysis depends on for a chain."""
+    chain = evaluate.normalize_chain(chain_json)
+    price = chain.info['underlying']['mark']
+    symbols = []
+    for expi in evaluate.select_expirations(chain, config):
+        try:
+            # Strikes used to estimate the expected move.
+            _, index = evaluate.get_closest_strike(expi.put_index, price)
+            symbols.extend(get_nearby(expi.puts, index, range(0, 3)))
+            _, index = evaluate.get_closest_strike(expi.call_index, price)
+            symbols.extend(get_nearby(expi.calls, index, range(0, 3)))
+        except IndexError:
+            continue
+
+        # Strikes selected for the position, and their neighbors.
+        term = evaluate.get_term(chain, expi, config)
+        if not term.put.HasField('strike'):
+            continue
+        _, index = evaluate.get_closest_strike(expi.put_index, Decimal(repr(term.put.strike)))
+        symbols.extend(get_nearby(expi.puts, index, range(-1, 2)))
+        _, index = evaluate.get_closest_strike(expi.call_index,
+                                               Decimal(repr(term.call.strike)))
+        symbols.extend(get_nearby(expi.calls, index, range(-1, 2)))
+
+    return list(dict.fromkeys(symbols))
+
+
+def fetch_quotes(td: ameritrade.AmeritradeAPI,
+                 limiter: Optional[ratelimit.TokenBucket],
+                 policy: retry.RetryPolicy,
+                 symbols: List[str]) -> dict[str, Json]:
+    """Fetch quotes for a list of symbols, in batches. Symbols of failed batches
+    are missing from the result."""
+    quotes = {}
+    for start in range(0, len(symbols), MAX_QUOTES_PER_REQUEST):
+        chunk = symbols[start:start + MAX_QUOTES_PER_REQUEST]
+        response, _ = policy.call(limiter, td.GetQuotes, symbol=','.join(chunk))
+        if 'error' in response:
+            logging.warning(f"Could not fetch quotes for {len(chunk)} symbols: "
+                            f"{response['error']}")
+            continue
+        quotes.update(response)
+    return quotes
+
+
+def get_stale(chain_json: Json, config: pb.Config, quotes: dict[str, Json]) -> List[str]:
+    """Return the symbols the analysis of a patched chain depends on which have
+    not been refreshed."""
+    return [symbol
+            for symbol in [chain_json['symbol']] + get_quote_symbols(chain_json, config)
+            if symbol not in quotes]
+
+
+def get_diagnostics(chain_json: Json) -> List[str]:
+    """Return the diagnostics recorded on a chain by a refresh."""
+    return chain_json.get(DIAGNOSTICS_FIELD, [])
+
+
+def patch_chain(chain_json: Json, quotes: dict[str, Json]):
+    """Update the markets of the options and underlying of a chain in-place."""
+    for field, quote_field in UNDERLYING_FIELDS:
+        quote = quotes.get(chain_json['symbol'])
+        if quote is not None and quote_field in quote:
+            chain_json['underlying'][field] = quote[quote_field]
+    if 'mark' in chain_json['underlying']:
+        chain_json['underlyingPrice'] = chain_json['underlying']['mark']
+
+    for expmap in chain_json['callExpDateMap'], chain_json['putExpDateMap']:
+        for strikes in expmap.values():
+            for datalist in strikes.values():
+                option = datalist[0]
+                quote = quotes.get(option['symbol'])
+                if quote is None:
+                    continue
+                for field, quote_field in OPTION_FIELDS:
+                    if quote_field in quote:
+                        option[field] = quote[quote_field]
+
+
+def refresh_chains(td: ameritrade.AmeritradeAPI,
+                   limiter: Optional[ratelimit.TokenBucket],
+                   policy: retry.RetryPolicy,
+                   chains: List[Tuple[str, Json]],
+                   config: pb.Config) -> Iterator[Tuple[str, Json]]:
+    """Refresh the quotes of the analyzed options of stored chains."""
+    valid = [chain_json for _, chain_json in chains if evaluate.is_valid_chain(chain_json)]
+    symbols = []
+    for chain_json in valid:
+        symbols.append(chain_json['symbol'])
+        symbols.extend(get_quote_symbols(chain_json, config))
+    quotes = fetch_quotes(td, limiter, policy, symbols)
+    for chain_json in valid:
+        patch_chain(chain_json, quotes)
+
+    # Fetch the markets of strikes selected anew after the patch.
+    stale = [get_stale(chain_json, config, quotes) for chain_json in valid]
+    missing = list(dict.fromkeys(symbol for symbols in stale for symbol in symbols))
+    if missing:
+        logging.info(f"Fetching {len(missing)} more quotes after re-selection")
+        quotes.update(fetch_quotes(td, limiter, policy, missing))
+        for chain_json, symbols in zip(valid, stale):
+            if symbols:
+                patch_chain(chain_json, quotes)
+        stale = [get_stale(chain_json, config, quotes) if symbols else []
+                 for chain_json, symbols in zip(valid, stale)]
+
+    # Flag the names still relying on stored markets.
+    for chain_json, symbols in zip(valid, stale):
+        if symbols:
+            listed = ', '.join(symbols[:MAX_LISTED_SYMBOLS])
+            more = len(symbols) - MAX_LISTED_SYMBOLS
+            chain_json[DIAGNOSTICS_FIELD] = [
+                f"WARNING: Stale quotes for {len(symbols)} symbols after refresh: "
+                f"{listed}{f' and {more} more' if more > 0 else ''}"]
+
+    yield from chains
@@ -0,0 +1,147 @@
+"""Retry policy for calls to the TD API."""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Callable, Optional, Tuple
+import argparse
+import logging
+import random
+import threading
+import time
+
+from overnight import ratelimit
+
+
+# Defaults for the retry policy.
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 8.0
+DEFAULT_BUDGET = 100
+
+# Longest time a single call waits out rate-limit refusals before giving up.
+DEFAULT_MAX_THROTTLE_SECS = 300.0
+
+
+def is_retryable(response: Any) -> bool:
+    """Return true if the response or exception is worth trying again.
+
+    Rate-limit refusals, server-side errors and connection failures are
+    transient. A 'FAILED' status is what TD returns for both invalid symbols and
+    hiccups on their end, so we retry it too, and let the attempt limit bound
+    the cost for symbols that really don't exist.
+    """
+    if isinstance(response, Exception):
+        return isinstance(response, (IOError, TimeoutError))
+    if not isinstance(response, dict):
+        return False
+    return 'error' in response or response.get('status') == 'FAILED'
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded per call and per run.
+
+    The budget is the total number of retries allowed across all calls made
+    with this policy in a run, so that a bad night for the API degrades into
+    dropped names rather than an endless run. Rate-limit refusals are not
+    failures: they are waited out without counting against the attempts or the
+    budget, up to a time limit. It is safe to share across threads.
+    """
+
+    def __init__(self,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY,
+                 budget: int = DEFAULT_BUDGET,
+                 classifier: Callable[[Any], bool] = is_retryable,
+                 max_throttle_secs: float = DEFAULT_MAX_THROTTLE_SECS):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.max_throttle_secs = max_throttle_secs
+        self.classifier = classifier
+        self.lock = threading.Lock()
+
+    def delay(self, attempt: int) -> float:
+        """Return a jittered delay before the given (zero-based) retry."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def take_budget(self) -> bool:
+        """Consume one retry from the run's budget. Return false if exhausted."""
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def call(self, limiter: Optional[ratelimit.TokenBucket],
+             func: Callable[..., Any], **kwargs) -> Tuple[Any, int]:
+        """Call an API method under the limiter, retrying transient failures.
+
+        Returns the last response and the number of retries it took. Exceptions
+        which are not retryable are raised; transient ones which persist beyond
+        the limits are returned as an error response, so that only the name
+        being fetched is lost.
+        """
+        retries = 0
+        throttles = 0
+        throttle_start = None
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                response = func(**kwargs)
+                failure = response
+            except Exception as exc:
+                response = None
+                failure = exc
+
+            if not self.classifier(failure):
+                if response is None:
+                    raise failure
+                return response, retries
+
+            # Wait out throttling, letting everyone else sharing the limiter
+            # slow down too.
+            if ratelimit.is_rate_limited(response):
+                if throttle_start is None:
+                    throttle_start = time.monotonic()
+                if time.monotonic() - throttle_start < self.max_throttle_secs:
+                    if limiter is not None:
+                        limiter.drain()
+                    else:
+                        time.sleep(self.delay(throttles))
+                    throttles += 1
+                    continue
+                logging.warning(f"Throttled on {func.__name__} {kwargs.get('symbol', '')} "
+                                f"for over {self.max_throttle_secs:.0f} secs")
+                return response, retries
+
+            if retries + 1 >= self.max_attempts or not self.take_budget():
+                if response is None:
+                    logging.warning(f"Giving up on {func.__name__} "
+                                    f"{kwargs.get('symbol', '')} ({failure})")
+                    return {'error': f"{type(failure).__name__}: {failure}"}, retries
+                return response, retries
+
+            delay = self.delay(retries)
+            retries += 1
+            logging.warning(f"Retrying {func.__name__} {kwargs.get('symbol', '')} "
+                            f"in {delay:.2f} secs ({failure})")
+            time.sleep(delay)
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add retry options to an argument parser."""
+    parser.add_argument('--max-attempts', action='store', type=int,
+                        default=DEFAULT_MAX_ATTEMPTS,
+                        help="Maximum number of attempts for each API call")
+    parser.add_argument('--retry-budget', action='store', type=int,
+                        default=DEFAULT_BUDGET,
+                        help="Maximum number of retries for the entire run")
+
+
+def policy_from_args(args: argparse.Namespace) -> RetryPolicy:
+    """Create a retry policy from parsed options."""
+    return RetryPolicy(max_attempts=args.max_attempts, budget=args.retry_budget)
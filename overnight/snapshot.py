@@ -0,0 +1,93 @@
+"""Archives of the raw chains fetched during a run.
+
+A snapshot is a single zip file in the output directory, with one compressed
+JSON member per symbol. Replaying it through the analysis allows trying out new
+configurations without touching the network.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+import logging
+import zipfile
+
+from overnight import chainjson
+
+
+# Name of the archive file in an output directory.
+SNAPSHOT_FILENAME = "chains.zip"
+
+
+class SnapshotWriter:
+    """Write raw chains to a snapshot archive."""
+
+    def __init__(self, output_dir: str):
+        self.filename = path.join(output_dir, SNAPSHOT_FILENAME)
+        self.archive = zipfile.ZipFile(self.filename, 'w',
+                                       compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, symbol: str, chain_json: Any):
+        """Add the chain for a symbol."""
+        self.archive.writestr(f"{symbol}.json", chainjson.dumps(chain_json))
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def anonymize_chain(chain_json: Any, alias: str) -> Any:
+    """Replace the identity of the underlying of a chain in-place, so that it can
+    be shared as a fixture. Markets and the shape of the chain are preserved."""
+    symbol = chain_json['symbol']
+    chain_json['symbol'] = alias
+    underlying = chain_json.get('underlying')
+    if underlying:
+        underlying['symbol'] = alias
+        underlying['description'] = f"{alias} Corp - Common Stock"
+    for field in 'callExpDateMap', 'putExpDateMap':
+        for strikes in chain_json.get(field, {}).values():
+            for datalist in strikes.values():
+                for option in datalist:
+                    for key in 'symbol', 'description':
+                        if key in option:
+                            option[key] = option[key].replace(symbol, alias, 1)
+    return chain_json
+
+
+def get_filename(snapshot_dir: str) -> str:
+    """Return the archive in an output directory. Accept the archive itself too."""
+    return (snapshot_dir
+            if path.isfile(snapshot_dir)
+            else path.join(snapshot_dir, SNAPSHOT_FILENAME))
+
+
+def read_symbols(snapshot_dir: str) -> List[str]:
+    """Return the sorted list of symbols in a snapshot."""
+    with zipfile.ZipFile(get_filename(snapshot_dir), 'r') as archive:
+        return sorted(path.splitext(name)[0] for name in archive.namelist())
+
+
+def read_snapshot(snapshot_dir: str,
+                  loads: Callable[[bytes], Any] = chainjson.loads,
+                  symbols: Optional[List[str]] = None) -> Iterator[Tuple[str, Any]]:
+    """Read (symbol, chain) pairs from a snapshot, in sorted symbol order. Use
+    `chainjson.loads_chain` for `loads` if the chains are only analyzed.
+
+    If `symbols` is provided, only those are read, in that order. Symbols missing
+    from the snapshot get an error response, like failed fetches.
+    """
+    with zipfile.ZipFile(get_filename(snapshot_dir), 'r') as archive:
+        names = {path.splitext(name)[0]: name for name in archive.namelist()}
+        for symbol in (sorted(names) if symbols is None else symbols):
+            if symbol in names:
+                yield symbol, loads(archive.read(names[symbol]))
+            else:
+                logging.warning(f"No chain for {symbol} in the snapshot")
+                yield symbol, {'error': "Not in snapshot"}
@@ -0,0 +1,79 @@
+"""Streaming output of earnings results while a run is in progress.
+
+Each finished `pb.Earnings` is appended to the results file of length-delimited
+binary messages (see `records`), and the HTML pages are regenerated at most
+every few seconds, so the tradeable names can be reviewed before the run
+completes.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Dict, List, Optional
+import logging
+import os
+import time
+
+from overnight import earnings_pb2 as pb
+from overnight import evaluate
+from overnight import moves
+from overnight import records
+from overnight import timing
+
+
+# Name of the streamed results file in an output directory. The final results
+# replace it at the end of the run.
+STREAM_FILENAME = records.EARNINGS_FILENAME
+
+# Default minimum interval between renderings of the pages.
+DEFAULT_INTERVAL_SECS = 10.0
+
+
+class StreamWriter:
+    """Append results to the stream file and periodically render the pages."""
+
+    def __init__(self, output_dir: str, interval_secs: float = DEFAULT_INTERVAL_SECS,
+                 timings: Optional[timing.Timings] = None,
+                 prior_moves: Optional[Dict[str, List[moves.Move]]] = None,
+                 text: bool = False):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.interval_secs = interval_secs
+        self.timings = timings
+        self.prior_moves = prior_moves
+        self.text = text
+        self.outfile = open(path.join(output_dir, STREAM_FILENAME), 'wb')
+        self.earlist = pb.EarningsList()
+        self.last_render = time.monotonic()
+        self.dirty = False
+
+    def add(self, earnings: pb.Earnings):
+        """Record a finished result."""
+        with timing.optional_stage(self.timings, 'write', earnings.underlying):
+            records.write_delimited(self.outfile, earnings)
+            self.outfile.flush()
+        self.earlist.earnings.append(earnings)
+        self.dirty = True
+        if time.monotonic() - self.last_render >= self.interval_secs:
+            self.render()
+
+    def render(self):
+        """Regenerate the pages from the results so far."""
+        if not self.dirty:
+            return
+        logging.info(f"Rendering {len(self.earlist.earnings)} results so far")
+        with timing.optional_stage(self.timings, 'render'):
+            evaluate.render_pages(self.earlist, self.output_dir, self.timings,
+                                  self.prior_moves, self.text)
+        self.last_render = time.monotonic()
+        self.dirty = False
+
+    def close(self):
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
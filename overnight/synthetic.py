@@ -0,0 +1,477 @@
+"""Synthetic TD chains, quotes and price histories, for load testing without an API account.
+
+This generates chain responses in the format of TD's GetOptionChain endpoint,
+with all its fields: weekly and regular expirations, strike ladders with
+spacings depending on the price, an implied volatility smile with a premium on
+the front terms (as ahead of earnings), Black-Scholes marks and greeks, spreads
+widening away from the money, some NaN greeks and zero sizes. Each symbol
+always produces the same chain for a given date, so that repeated requests for
+it (e.g. probes and narrowed fetches) agree. Daily price histories are random
+walks with a large overnight gap about once a quarter, like announcements.
+
+`SyntheticAmeritrade` stands in for the API object and serves these.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from typing import Any, Dict, Iterator, List, Optional
+import argparse
+import datetime
+import math
+import random
+import zlib
+
+from overnight import chainjson
+
+
+Json = Dict[str, Any]
+
+# Default number of strikes on each side of the money, for each expiration.
+DEFAULT_NUM_STRIKES = 30
+
+# Default number of months of regular expirations.
+DEFAULT_NUM_MONTHS = 6
+
+# Number of weeks of weekly expirations.
+NUM_WEEKLIES = 6
+
+# Fraction of the options with NaN greeks and with no size.
+NAN_FRACTION = 0.02
+NO_SIZE_FRACTION = 0.05
+
+# Risk-free rate used for pricing.
+INTEREST_RATE = 0.01
+
+# First date of the synthetic price histories.
+HISTORY_START = datetime.date(2018, 1, 1)
+
+# Daily volatility of the price histories, and that of the overnight gaps on
+# the (roughly quarterly) days with an announcement.
+DAILY_VOL = 0.02
+EARNINGS_VOL = 0.07
+EARNINGS_FRACTION = 1 / 63
+
+
+def get_symbols(num_names: int) -> List[str]:
+    """Return a list of distinct made-up symbols."""
+    symbols = []
+    for index in range(num_names):
+        letters = ''
+        index += 26 + 26 * 26
+        while index:
+            index, letter = divmod(index, 26)
+            letters = chr(ord('A') + letter) + letters
+        symbols.append(letters)
+    return symbols
+
+
+def get_rng(*keys: Any) -> random.Random:
+    """Return a random number generator seeded by a symbol, date, etc."""
+    return random.Random(zlib.crc32(':'.join(map(str, keys)).encode('ascii')))
+
+
+def get_strike_spacing(price: float) -> float:
+    """Return a typical spacing of strikes for an underlying price."""
+    for bound, spacing in [(5, 0.5), (25, 1.0), (200, 2.5), (500, 5.0)]:
+        if price < bound:
+            return spacing
+    return 10.0
+
+
+def get_expirations(today: datetime.date, num_months: int) -> Iterator[tuple]:
+    """Generate (date, type) pairs of weekly and regular Friday expirations."""
+    friday = today + datetime.timedelta(days=(4 - today.weekday()) % 7 or 7)
+    last_date = today + datetime.timedelta(days=31 * num_months)
+    date = friday
+    while date <= last_date:
+        is_regular = 15 <= date.day <= 21
+        weeks_out = (date - friday).days // 7
+        if is_regular or weeks_out < NUM_WEEKLIES:
+            yield date, 'R' if is_regular else 'W'
+        date += datetime.timedelta(days=7)
+
+
+def norm_cdf(x: float) -> float:
+    """Standard normal cumulative distribution."""
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def norm_pdf(x: float) -> float:
+    """Standard normal density."""
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+
+def price_option(is_call: bool, spot: float, strike: float, years: float,
+                 vol: float) -> Dict[str, float]:
+    """Return the Black-Scholes price and greeks of an option."""
+    sqrt_t = math.sqrt(years)
+    d1 = (math.log(spot / strike) + (INTEREST_RATE + vol * vol / 2) * years) / (vol * sqrt_t)
+    d2 = d1 - vol * sqrt_t
+    discount = math.exp(-INTEREST_RATE * years)
+    if is_call:
+        value = spot * norm_cdf(d1) - strike * discount * norm_cdf(d2)
+        delta = norm_cdf(d1)
+        rho = strike * years * discount * norm_cdf(d2) / 100
+    else:
+        value = strike * discount * norm_cdf(-d2) - spot * norm_cdf(-d1)
+        delta = norm_cdf(d1) - 1
+        rho = -strike * years * discount * norm_cdf(-d2) / 100
+    gamma = norm_pdf(d1) / (spot * vol * sqrt_t)
+    vega = spot * norm_pdf(d1) * sqrt_t / 100
+    theta = (-spot * norm_pdf(d1) * vol / (2 * sqrt_t) -
+             INTEREST_RATE * strike * discount * (norm_cdf(d2) if is_call else -norm_cdf(-d2)))
+    return {'value': max(value, 0.), 'delta': delta, 'gamma': gamma,
+            'theta': theta / 365, 'vega': vega, 'rho': rho}
+
+
+def format_strike(strike: float) -> str:
+    """Format a strike as it appears in option symbols."""
+    return f"{strike:g}"
+
+
+def generate_option(rng: random.Random, symbol: str, is_call: bool, spot: float,
+                    strike: float, date: datetime.date, expi_type: str, dte: int,
+                    vol: float, quote_time: int) -> Json:
+    """Generate the data for a single option."""
+    years = max(dte, 0.5) / 365
+    greeks = price_option(is_call, spot, strike, years, vol)
+    mark = round(greeks['value'], 2)
+
+    # Spreads widen away from the money and on cheap options.
+    moneyness = abs(math.log(strike / spot))
+    spread = max(0.01, round(0.02 + mark * rng.uniform(0.02, 0.10) +
+                             moneyness * rng.uniform(0., 0.5), 2))
+    bid = max(0., round(mark - spread / 2, 2))
+    ask = round(bid + spread, 2)
+    mark = round((bid + ask) / 2, 2)
+    bid_size = 0 if rng.random() < NO_SIZE_FRACTION else rng.randint(1, 200)
+    ask_size = 0 if rng.random() < NO_SIZE_FRACTION else rng.randint(1, 200)
+    is_nan = rng.random() < NAN_FRACTION or mark == 0
+
+    put_call = 'CALL' if is_call else 'PUT'
+    expiration_ms = int(datetime.datetime(date.year, date.month, date.day, 16).timestamp() * 1000)
+    intrinsic = max(0., spot - strike if is_call else strike - spot)
+    last = max(0.01, round(mark * rng.uniform(0.9, 1.1), 2))
+    close = max(0.01, round(mark * rng.uniform(0.85, 1.15), 2))
+
+    def greek(value, digits=3):
+        return 'NaN' if is_nan else round(value, digits)
+
+    weekly = ' (Weekly)' if expi_type == 'W' else ''
+    return {
+        'putCall': put_call,
+        'symbol': f"{symbol}_{date:%m%d%y}{put_call[0]}{format_strike(strike)}",
+        'description': (f"{symbol} {date:%b} {date.day} {date.year} "
+                        f"{format_strike(strike)} {put_call.title()}{weekly}"),
+        'exchangeName': 'OPR',
+        'bid': bid,
+        'ask': ask,
+        'last': last,
+        'mark': mark,
+        'bidSize': bid_size,
+        'askSize': ask_size,
+        'bidAskSize': f"{bid_size}X{ask_size}",
+        'lastSize': 0,
+        'highPrice': max(last, close),
+        'lowPrice': min(last, close),
+        'openPrice': 0.,
+        'closePrice': close,
+        'totalVolume': rng.randint(0, 5000),
+        'tradeDate': None,
+        'tradeTimeInLong': quote_time,
+        'quoteTimeInLong': quote_time,
+        'netChange': round(last - close, 2),
+        'volatility': greek(vol * 100),
+        'delta': greek(greeks['delta']),
+        'gamma': greek(greeks['gamma']),
+        'theta': greek(greeks['theta']),
+        'vega': greek(greeks['vega']),
+        'rho': greek(greeks['rho']),
+        'openInterest': rng.randint(0, 20000),
+        'timeValue': round(max(0., mark - intrinsic), 2),
+        'theoreticalOptionValue': round(greeks['value'], 3),
+        'theoreticalVolatility': 29.0,
+        'optionDeliverablesList': None,
+        'strikePrice': strike,
+        'expirationDate': expiration_ms,
+        'daysToExpiration': dte,
+        'expirationType': expi_type,
+        'lastTradingDay': expiration_ms,
+        'multiplier': 100.,
+        'settlementType': ' ',
+        'deliverableNote': '',
+        'isIndexOption': None,
+        'percentChange': round((last - close) / close * 100, 2),
+        'markChange': round(mark - close, 2),
+        'markPercentChange': round((mark - close) / close * 100, 2),
+        'intrinsicValue': round(intrinsic, 2),
+        'nonStandard': False,
+        'inTheMoney': intrinsic > 0,
+        'mini': False,
+        'pennyPilot': True,
+    }
+
+
+def generate_chain_data(symbol: str,
+                        today: datetime.date,
+                        num_strikes: int = DEFAULT_NUM_STRIKES,
+                        num_months: int = DEFAULT_NUM_MONTHS,
+                        to_date: Optional[datetime.date] = None) -> Json:
+    """Generate a chain response for a symbol, as plain JSON data, with the
+    expirations up to an optional date. Each expiration is generated from its
+    own seed, so it is the same regardless of the date range."""
+    rng = get_rng(symbol, today)
+    spot = round(math.exp(rng.uniform(math.log(3), math.log(800))), 2)
+    base_vol = rng.uniform(0.20, 0.90)
+    skew = rng.uniform(0.1, 0.6)
+    smile = rng.uniform(0.5, 3.0)
+    earnings_premium = rng.uniform(0.3, 1.5)
+    close = round(spot * rng.uniform(0.93, 1.07), 2)
+    quote_time = int(datetime.datetime(today.year, today.month, today.day, 16).timestamp() * 1000)
+
+    spacing = get_strike_spacing(spot)
+    center = round(spot / spacing) * spacing
+    strikes = [round(center + offset * spacing, 2)
+               for offset in range(-num_strikes, num_strikes + 1)
+               if center + offset * spacing > 0]
+
+    call_map, put_map = {}, {}
+    for date, expi_type in get_expirations(today, num_months):
+        if to_date is not None and date > to_date:
+            break
+        dte = (date - today).days
+        key = f"{date.isoformat()}:{dte}"
+        expi_rng = get_rng(symbol, today, key)
+        # The premium from the announcement decays with the square root of time.
+        term_vol = base_vol * (1 + earnings_premium * math.sqrt(7 / max(dte, 1)) / 3)
+        call_map[key], put_map[key] = {}, {}
+        for strike in strikes:
+            log_moneyness = math.log(strike / spot)
+            vol = max(0.05, term_vol * (1 - skew * log_moneyness + smile * log_moneyness ** 2))
+            for is_call, expmap in [(True, call_map), (False, put_map)]:
+                option = generate_option(expi_rng, symbol, is_call, spot, strike, date,
+                                         expi_type, dte, vol, quote_time)
+                expmap[key][f"{strike:.1f}"] = [option]
+
+    underlying = {
+        'symbol': symbol,
+        'description': f"{symbol} Synthetic Corp - Common Stock",
+        'change': round(spot - close, 2),
+        'percentChange': round((spot - close) / close * 100, 2),
+        'close': close,
+        'quoteTime': quote_time,
+        'tradeTime': quote_time,
+        'bid': round(spot - 0.01, 2),
+        'ask': round(spot + 0.01, 2),
+        'last': spot,
+        'mark': spot,
+        'markChange': round(spot - close, 2),
+        'markPercentChange': round((spot - close) / close * 100, 2),
+        'bidSize': rng.randint(1, 50) * 100,
+        'askSize': rng.randint(1, 50) * 100,
+        'highPrice': round(max(spot, close) * 1.01, 2),
+        'lowPrice': round(min(spot, close) * 0.99, 2),
+        'openPrice': close,
+        'totalVolume': int(math.exp(rng.uniform(math.log(2e4), math.log(5e7)))),
+        'exchangeName': 'NYS',
+        'fiftyTwoWeekHigh': round(spot * rng.uniform(1.0, 1.8), 2),
+        'fiftyTwoWeekLow': round(spot * rng.uniform(0.4, 1.0), 2),
+        'delayed': False,
+    }
+    return {
+        'symbol': symbol,
+        'status': 'SUCCESS',
+        'underlying': underlying,
+        'strategy': 'SINGLE',
+        'interval': 0.0,
+        'isDelayed': False,
+        'isIndex': False,
+        'interestRate': INTEREST_RATE * 100,
+        'underlyingPrice': spot,
+        'volatility': 29.0,
+        'daysToExpiration': 0.0,
+        'numberOfContracts': 2 * len(strikes) * len(call_map),
+        'callExpDateMap': call_map,
+        'putExpDateMap': put_map,
+    }
+
+
+def generate_price_history(symbol: str,
+                           start: datetime.date,
+                           end: datetime.date) -> Json:
+    """Generate a daily price history response for a symbol, as plain JSON data.
+    The walk always starts from the same date, so that overlapping ranges
+    agree."""
+    rng = get_rng(symbol, 'history')
+    close = math.exp(rng.uniform(math.log(3), math.log(800)))
+    candles = []
+    date = HISTORY_START
+    while date <= end:
+        if date.weekday() < 5:
+            day_rng = get_rng(symbol, date)
+            gap_vol = EARNINGS_VOL if day_rng.random() < EARNINGS_FRACTION else DAILY_VOL / 4
+            open_ = close * math.exp(day_rng.gauss(0, gap_vol))
+            close = open_ * math.exp(day_rng.gauss(0, DAILY_VOL))
+            if date >= start:
+                midnight = datetime.datetime(date.year, date.month, date.day, 6,
+                                             tzinfo=datetime.timezone.utc)
+                candles.append({
+                    'open': round(open_, 2),
+                    'high': round(max(open_, close) * (1 + abs(day_rng.gauss(0, 0.005))), 2),
+                    'low': round(min(open_, close) * (1 - abs(day_rng.gauss(0, 0.005))), 2),
+                    'close': round(close, 2),
+                    'volume': day_rng.randint(20_000, 50_000_000),
+                    'datetime': int(midnight.timestamp() * 1000),
+                })
+        date += datetime.timedelta(days=1)
+    return {'candles': candles, 'symbol': symbol, 'empty': not candles}
+
+
+def restrict_chain(chain_data: Json, strike_count: Optional[int]) -> Json:
+    """Restrict a chain to a number of strikes around the money, like the
+    strikeCount request parameter does."""
+    restricted = {key: value for key, value in chain_data.items()
+                  if key not in ('callExpDateMap', 'putExpDateMap')}
+    spot = chain_data['underlyingPrice']
+    for field in 'callExpDateMap', 'putExpDateMap':
+        expmap = {}
+        for key, strikes in chain_data[field].items():
+            names = list(strikes)
+            if strike_count is not None:
+                # Keep the strikes closest to the money, in their original order.
+                closest = sorted(names, key=lambda name: abs(float(name) - spot))
+                kept = set(closest[:strike_count])
+                names = [name for name in names if name in kept]
+            expmap[key] = {name: strikes[name] for name in names}
+        restricted[field] = expmap
+    return restricted
+
+
+def to_quote(option: Json) -> Json:
+    """Convert the data of an option to the fields of a quote response."""
+    return {
+        'symbol': option['symbol'],
+        'description': option['description'],
+        'bidPrice': option['bid'],
+        'askPrice': option['ask'],
+        'lastPrice': option['last'],
+        'mark': option['mark'],
+        'closePrice': option['closePrice'],
+        'bidSize': option['bidSize'],
+        'askSize': option['askSize'],
+        'delta': option['delta'],
+        'volatility': option['volatility'],
+        'totalVolume': option['totalVolume'],
+        'openInterest': option['openInterest'],
+        'quoteTimeInLong': option['quoteTimeInLong'],
+        'netPercentChangeInDouble': option['percentChange'],
+    }
+
+
+def to_underlying_quote(underlying: Json) -> Json:
+    """Convert the data of an underlying to the fields of a quote response."""
+    return {
+        'symbol': underlying['symbol'],
+        'description': underlying['description'],
+        'bidPrice': underlying['bid'],
+        'askPrice': underlying['ask'],
+        'lastPrice': underlying['last'],
+        'mark': underlying['mark'],
+        'closePrice': underlying['close'],
+        'bidSize': underlying['bidSize'],
+        'askSize': underlying['askSize'],
+        'totalVolume': underlying['totalVolume'],
+        'quoteTimeInLong': underlying['quoteTime'],
+        'netPercentChangeInDouble': underlying['percentChange'],
+        '52WkHigh': underlying['fiftyTwoWeekHigh'],
+        '52WkLow': underlying['fiftyTwoWeekLow'],
+    }
+
+
+class SyntheticAmeritrade:
+    """A stand-in for the TD API object, serving synthetic chains and quotes.
+
+    Responses are decoded like the API library's, with attribute access and
+    Decimal numbers.
+    """
+
+    def __init__(self,
+                 num_strikes: int = DEFAULT_NUM_STRIKES,
+                 num_months: int = DEFAULT_NUM_MONTHS,
+                 today: Optional[datetime.date] = None):
+        self.num_strikes = num_strikes
+        self.num_months = num_months
+        self.today = today or datetime.date.today()
+
+    def get_chain_data(self, symbol: str,
+                       to_date: Optional[datetime.date] = None) -> Json:
+        """Return the chain data of a symbol."""
+        return generate_chain_data(symbol, self.today, self.num_strikes, self.num_months,
+                                   to_date)
+
+    def get_quote_data(self, symbol: str) -> Optional[Json]:
+        """Return the quote data for an underlying or option symbol."""
+        underlying, _, option_part = symbol.partition('_')
+        if not option_part:
+            chain_data = self.get_chain_data(underlying, self.today)
+            return to_underlying_quote(chain_data['underlying'])
+        # Option symbols have the expiration date and side after the underlying.
+        try:
+            date = datetime.datetime.strptime(option_part[:6], '%m%d%y').date()
+        except ValueError:
+            return None
+        chain_data = self.get_chain_data(underlying, date)
+        field = 'callExpDateMap' if option_part[6:7] == 'C' else 'putExpDateMap'
+        for strikes in chain_data[field].values():
+            for datalist in strikes.values():
+                if datalist[0]['symbol'] == symbol:
+                    return to_quote(datalist[0])
+        return None
+
+    def GetOptionChain(self, symbol: str, strikeCount: Optional[int] = None,
+                       toDate: Optional[datetime.date] = None, **kwargs) -> Any:
+        chain_data = restrict_chain(self.get_chain_data(symbol, toDate), strikeCount)
+        return chainjson.loads(chainjson.dumps(chain_data))
+
+    def GetQuotes(self, symbol: str, **kwargs) -> Any:
+        quotes = {}
+        for name in symbol.split(','):
+            quote = self.get_quote_data(name)
+            if quote is not None:
+                quotes[name] = quote
+        return chainjson.loads(chainjson.dumps(quotes))
+
+    def GetQuote(self, symbol: str, **kwargs) -> Any:
+        return self.GetQuotes(symbol=symbol)
+
+    def GetPriceHistory(self, symbol: str, startDate: Optional[int] = None,
+                        endDate: Optional[int] = None, **kwargs) -> Any:
+        def to_date(millis: Optional[int], default: datetime.date) -> datetime.date:
+            if millis is None:
+                return default
+            return datetime.datetime.fromtimestamp(millis / 1000, datetime.timezone.utc).date()
+        history = generate_price_history(
+            symbol,
+            to_date(startDate, self.today - datetime.timedelta(days=365)),
+            min(to_date(endDate, self.today), self.today))
+        return chainjson.loads(chainjson.dumps(history))
+
+
+def add_args(parser: argparse.ArgumentParser):
+    """Add options to run against synthetic data to an argument parser."""
+    parser.add_argument('--synthetic', action='store_true',
+                        help="Serve synthetic chains instead of calling the API")
+    parser.add_argument('--synthetic-names', action='store', type=int,
+                        help=("If no symbols are given, make up this many "
+                              "(implies --synthetic)"))
+    parser.add_argument('--synthetic-strikes', action='store', type=int,
+                        default=DEFAULT_NUM_STRIKES,
+                        help="Number of synthetic strikes on each side of the money")
+
+
+def api_from_args(args: argparse.Namespace) -> Optional[SyntheticAmeritrade]:
+    """Create a synthetic API from parsed options, or None if not requested."""
+    if not args.synthetic and not args.synthetic_names:
+        return None
+    return SyntheticAmeritrade(args.synthetic_strikes)
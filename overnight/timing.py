@@ -0,0 +1,120 @@
+"""Timings of the stages of a run.
+
+Time is accumulated per stage (fetch, serialize and decode for the process
+pool, normalize, analyze, render, write), for the whole run and for each
+symbol, so that both slow stages and slow names stand out. Stages running
+concurrently on threads or processes add up their busy time, which can exceed
+the wall time of the run.
+"""
+
+__copyright__ = "Copyright (C) 2021  Martin Blais"
+__license__ = "GNU GPLv2"
+
+from os import path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import collections
+import contextlib
+import functools
+import json
+import threading
+import time
+
+
+# Name of the timings file in an output directory.
+TIMINGS_FILENAME = "timings.json"
+
+# Stages in the order of a run, for presentation. Others come after.
+STAGES = ['fetch', 'serialize', 'decode', 'normalize', 'analyze', 'render', 'write']
+
+
+class Timings:
+    """Accumulated stage timings of a run. Safe to share across threads."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.maxima = collections.defaultdict(float)
+        self.symbols = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, secs: float, symbol: Optional[str] = None):
+        """Record time spent in a stage, on behalf of a symbol if given."""
+        with self.lock:
+            self.totals[stage] += secs
+            self.counts[stage] += 1
+            self.maxima[stage] = max(self.maxima[stage], secs)
+            if symbol is not None:
+                self.symbols[symbol][stage] += secs
+
+    def merge(self, stages: Dict[str, float], symbol: Optional[str] = None):
+        """Record the stage times measured elsewhere, e.g. in a worker process."""
+        for stage, secs in stages.items():
+            self.add(stage, secs, symbol)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, symbol: Optional[str] = None) -> Iterator[None]:
+        """Time the body of a with-statement."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, symbol)
+
+    def wrap(self, stage: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Wrap a function to time its calls, on behalf of their 'symbol' keyword
+        argument if present."""
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.stage(stage, kwargs.get('symbol')):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def get_wall(self) -> float:
+        """Return the time elapsed since the start of the run."""
+        return time.monotonic() - self.started
+
+    def get_stages(self) -> List[Dict[str, Any]]:
+        """Return a summary of each stage, in run order."""
+        with self.lock:
+            names = sorted(self.totals, key=lambda name: (
+                STAGES.index(name) if name in STAGES else len(STAGES), name))
+            return [{'stage': name,
+                     'total': self.totals[name],
+                     'count': self.counts[name],
+                     'mean': self.totals[name] / self.counts[name],
+                     'max': self.maxima[name]}
+                    for name in names]
+
+    def get_slowest(self, num: int = 10) -> List[Dict[str, Any]]:
+        """Return the symbols which took the most time overall."""
+        with self.lock:
+            totals = [(sum(stages.values()), symbol, dict(stages))
+                      for symbol, stages in self.symbols.items()]
+        totals.sort(key=lambda item: item[0], reverse=True)
+        return [{'symbol': symbol, 'total': total, 'stages': stages}
+                for total, symbol, stages in totals[:num]]
+
+    def to_json(self) -> Dict[str, Any]:
+        """Return all the timings as JSON-compatible data."""
+        with self.lock:
+            symbols = {symbol: dict(stages) for symbol, stages in sorted(self.symbols.items())}
+        return {'wall': self.get_wall(),
+                'stages': self.get_stages(),
+                'symbols': symbols}
+
+    def write(self, output_dir: str):
+        """Write the timings to the output directory."""
+        with open(path.join(output_dir, TIMINGS_FILENAME), "w") as outfile:
+            json.dump(self.to_json(), outfile, indent=1)
+
+
+@contextlib.contextmanager
+def optional_stage(timings: Optional[Timings], stage: str,
+                   symbol: Optional[str] = None) -> Iterator[None]:
+    """Time the body of a with-statement if timings are being recorded."""
+    if timings is None:
+        yield
+    else:
+        with timings.stage(stage, symbol):
+            yield